@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from cleaning import clean_raw_lyrics, clean_lyrics
+from storage import TEXT_DTYPE
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SAMPLE_SIZE = 2 * (10**4)
+
+
+def legacy_clean_raw_lyrics(lyrics):
+    # make_processed.py before the shared cleaning engine
+    lyrics = lyrics.str.replace(r"(?m)^\[.*?\]$", "", regex=True)
+    return lyrics.str.replace(r"\n|\n\n", " ", regex=True)
+
+
+def legacy_clean_lyric_content(lyric_text):
+    # build_features.py before the shared cleaning engine
+    try:
+        contributor_pattern = re.compile(
+            r'\d+ ContributorsTranslations.*?Lyrics')
+        bracket_pattern = re.compile(r'\[.*?\](?!\[s:|\[e:)')
+        ascii_pattern = re.compile(r'[^\x00-\x7F]+')
+        newline_pattern = re.compile(r'\n{3,}')
+
+        lyric_text = re.sub(contributor_pattern, '', lyric_text)
+        lyric_text = re.sub(bracket_pattern, '', lyric_text)
+        lyric_text = re.sub(ascii_pattern, ' ', lyric_text)
+        lyric_text = re.sub(newline_pattern, '\n\n', lyric_text)
+
+        lyric_text = lyric_text.replace('"', '')
+
+        return lyric_text.strip()
+    except:
+        return ""
+
+
+def synthetic_lyrics(n, seed=0):
+    """
+        Genius-like lyrics: a contributors header (with translations for some songs),
+        section headers, annotations, quotes, runs of empty lines and accented words in some songs.
+    """
+    rng = np.random.default_rng(seed)
+    words = np.array(["love", "night", "baby", "yeah", "money", "heart", "city", "fire", '"real"', "dance"])
+    accented = np.array(["café", "niño", "señorita", "déjà"])
+    lyrics = []
+    for i in range(n):
+        song_words = np.concatenate([words, accented]) if rng.random() < 0.1 else words
+        sections = []
+        for section in ("Verse 1", "Chorus", "Verse 2", "Chorus", "Outro"):
+            lines = [" ".join(rng.choice(song_words, rng.integers(4, 10))) for _ in range(rng.integers(2, 6))]
+            sections.append(f"[{section}]\n" + "\n".join(lines) + "\n" * int(rng.integers(1, 4)))
+        header = "ContributorsTranslationsEspañol" if rng.random() < 0.1 else "Contributors"
+        lyrics.append(f"{rng.integers(1, 200)} {header}Song {i} Lyrics" + "\n".join(sections) + "[Produced by X]")
+    return pd.Series(lyrics, dtype=object)
+
+
+def load_sample(n):
+    raw_filepath = Path(os.path.join(PROJECT_DIR, "data", "raw", "song_lyrics.csv"))
+    if os.path.exists(raw_filepath):
+        return pd.read_csv(raw_filepath, usecols=["lyrics"], nrows=n)["lyrics"].dropna().reset_index(drop=True)
+    return synthetic_lyrics(n)
+
+
+def bench(name, func, lyrics, repeat=3):
+    best = min(_timed(func, lyrics) for _ in range(repeat))
+    return {"stage": name, "rows": len(lyrics), "seconds": best, "rows_per_sec": len(lyrics) / best}
+
+
+def _timed(func, lyrics):
+    start = time.perf_counter()
+    func(lyrics)
+    return time.perf_counter() - start
+
+
+def benchCleaning(n=SAMPLE_SIZE, repeat=5):
+    """
+        Compares the rows/sec (best of repeat runs) of the shared cleaning engine against the previous
+        per-stage cleaning on a sample of the raw data (or synthetic lyrics if it isn't downloaded),
+        for make_processed.py on Python and on Arrow strings (TEXT_DTYPE, which it reads),
+        and checks that both produce the same lyrics.
+    """
+    logger = logging.getLogger(__name__)
+    lyrics = load_sample(n)
+    arrow_lyrics = lyrics.astype(TEXT_DTYPE)
+    logger.info(f'benchmarking lyric cleaning on {len(lyrics)} rows')
+
+    results = pd.DataFrame([
+        bench("make_processed (legacy)", legacy_clean_raw_lyrics, lyrics, repeat),
+        bench("make_processed (engine)", clean_raw_lyrics, lyrics, repeat),
+        bench("make_processed, arrow (legacy)", legacy_clean_raw_lyrics, arrow_lyrics, repeat),
+        bench("make_processed, arrow (engine)", clean_raw_lyrics, arrow_lyrics, repeat),
+        bench("build_features (legacy)", lambda x: x.apply(legacy_clean_lyric_content), lyrics, repeat),
+        bench("build_features (engine)", clean_lyrics, lyrics, repeat),
+    ])
+    logger.info('\n' + results.to_string(index=False))
+
+    raw_mismatches = ((legacy_clean_raw_lyrics(lyrics) != clean_raw_lyrics(lyrics)).sum()
+                      + (legacy_clean_raw_lyrics(arrow_lyrics) != clean_raw_lyrics(arrow_lyrics)).sum())
+    feature_mismatches = (lyrics.apply(legacy_clean_lyric_content) != clean_lyrics(lyrics)).sum()
+    logger.info(f'mismatching rows: make_processed {raw_mismatches}, build_features {feature_mismatches}')
+    if raw_mismatches or feature_mismatches:
+        raise ValueError(f"The cleaning engine doesn't match the legacy cleaning: {raw_mismatches} rows "
+                         f"in make_processed, {feature_mismatches} rows in build_features")
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchCleaning()
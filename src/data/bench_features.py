@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+from build_features import lyrics_prompter, process_lyrics_file
+from bench_cleaning import synthetic_lyrics, legacy_clean_lyric_content
+from storage import write_chunk
+
+SAMPLE_SIZE = 2 * (10**4)
+ROSTER = {
+    "rap": {"Drake", "50 Cent", "Nas"},
+    "pop": {"Adele", "Madonna"},
+    "rb": {"SZA", "Usher"},
+}
+
+
+def synthetic_processed(n, seed=0):
+    """
+        Processed-like rows of the roster's artists (and others), their tags in mixed case
+        ("rap", "Rap", "RAP", ...). Their views are distinct, so the most viewed songs don't depend
+        on the order a partitioned data set is read in.
+    """
+    rng = np.random.default_rng(seed)
+    tags = ["rap", "Rap", "RAP", "pop", "Pop", "rb", "R&B", "rock", "country"]
+    artists = ["Drake", "drake feat. Nas", "50 Cent", "Adele", "MADONNA", "SZA", "Usher", "Someone Else"]
+    return pd.DataFrame({
+        "title": [f"song {i}" for i in range(n)],
+        "tag": rng.choice(tags, n),
+        "artist": rng.choice(artists, n),
+        "year": rng.integers(1960, 2023, n),
+        "views": rng.permutation(n),
+        "features": "",
+        "lyrics": synthetic_lyrics(n, seed),
+    })
+
+
+def legacy_process_lyrics_file(input_filepath, output_filepath, genres_artists):
+    # build_features.py before the Parquet storage and the streaming feature build
+    df = pd.read_csv(input_filepath)
+    df = df[['title', 'artist', 'tag', 'year', 'views', 'lyrics']]
+    final_lyrics_df = pd.DataFrame(columns=[
+                                   'title', 'artist', 'tag', 'year', 'views', 'lyrics', "cleaned_lyrics", "final_lyrics"])
+    for genre, artists in genres_artists.items():
+        genre_df = df[df['tag'].str.lower() == genre.lower()]
+        for artist in artists:
+            artist_df = genre_df[genre_df['artist'].str.contains(artist, case=False, regex=False)]
+            top_songs = artist_df.nlargest(min(300, len(artist_df)), 'views')
+            top_songs['cleaned_lyrics'] = top_songs['lyrics'].apply(legacy_clean_lyric_content)
+            top_songs = top_songs.dropna()
+            top_songs['final_lyrics'] = top_songs.apply(lambda x: lyrics_prompter(
+                x["cleaned_lyrics"], genre, artist, x["year"]), axis=1)
+            final_lyrics_df = pd.concat([final_lyrics_df, top_songs], ignore_index=True)
+    final_lyrics_df.to_csv(output_filepath, index=False)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def benchFeatures(n=SAMPLE_SIZE, chunksize=997):
+    """
+        Checks that process_lyrics_file writes byte for byte the features the legacy builder wrote,
+        from csv and tag partitioned Parquet inputs whose tags differ in case from the roster's genres
+        (which the legacy builder matched ignoring case), and compares their seconds.
+    """
+    logger = logging.getLogger(__name__)
+    songs = synthetic_processed(n)
+    logger.info(f'benchmarking the feature build on {len(songs)} rows, tags {sorted(songs["tag"].unique())}')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        csv_filepath = os.path.join(tmpdir, "processed.csv")
+        parquet_filepath = os.path.join(tmpdir, "processed.parquet")
+        songs.to_csv(csv_filepath, index=False)
+        write_chunk(songs, parquet_filepath, 0, partition_col="tag")
+
+        legacy_filepath = os.path.join(tmpdir, "legacy.csv")
+        results = [{"builder": "legacy", "input": "csv",
+                    "seconds": _timed(legacy_process_lyrics_file, csv_filepath, legacy_filepath, ROSTER)}]
+        with open(legacy_filepath, encoding="utf-8") as f:
+            expected = f.read()
+
+        mismatches = {}
+        for name, input_filepath in (("csv", csv_filepath), ("parquet", parquet_filepath)):
+            output_filepath = os.path.join(tmpdir, f"features_{name}.csv")
+            seconds = _timed(process_lyrics_file, input_filepath, output_filepath, ROSTER, chunksize)
+            results.append({"builder": "streaming", "input": name, "seconds": seconds})
+            with open(output_filepath, encoding="utf-8") as f:
+                mismatches[name] = f.read() != expected
+
+    results = pd.DataFrame(results)
+    logger.info('\n' + results.to_string(index=False))
+    logger.info(f'features differing from the legacy builder: {mismatches}')
+    if any(mismatches.values()):
+        raise ValueError(f"process_lyrics_file doesn't match the legacy builder: {mismatches}")
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchFeatures()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import os
+import logging
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from storage import iter_csv_tables, to_compact_pandas
+from instrumentation import peak_rss_mb, rss_mb
+from bench_cleaning import synthetic_lyrics
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+SAMPLE_SIZE = 10**5
+RAW_COLUMNS = ["title", "tag", "artist", "year", "views", "lyrics"]
+
+
+def synthetic_raw(n, seed=0):
+    """
+        Raw-like rows: a handful of genres, a few thousand artists and Genius-like lyrics.
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "title": [f"song {i}" for i in range(n)],
+        "tag": rng.choice(["rap", "pop", "rock", "rb", "country", "misc"], n),
+        "artist": [f"artist {i}" for i in rng.integers(0, 5000, n)],
+        "year": rng.integers(1960, 2023, n),
+        "views": rng.integers(0, 10**6, n),
+        "lyrics": synthetic_lyrics(n, seed),
+    })
+
+
+def load(filepath, n, compact):
+    """
+        Loads n rows of the raw data like the stages did before (text as Python objects)
+        or with the compact dtypes.
+    """
+    if compact:
+        return to_compact_pandas(next(iter_csv_tables(filepath, RAW_COLUMNS, n)))
+    text_columns = ["title", "tag", "artist", "lyrics"]
+    return pd.read_csv(filepath, nrows=n, usecols=RAW_COLUMNS, dtype={col: object for col in text_columns})
+
+
+def _measure(filepath, n, compact):
+    # runs in a fresh process, so its peak RSS only covers loading the sample
+    start_rss = rss_mb()
+    df = load(filepath, n, compact)
+    return {
+        "dtypes": "compact" if compact else "legacy",
+        "rows": len(df),
+        "frame_mb": df.memory_usage(deep=True).sum() / 2**20,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_growth_mb": peak_rss_mb() - start_rss if start_rss is not None else None,
+    }
+
+
+def benchMemory(n=SAMPLE_SIZE):
+    """
+        Compares the memory taken by a sample of the raw data (or synthetic rows if it isn't downloaded)
+        loaded with object columns against the compact dtypes shared by every stage.
+        Each load runs in its own process so the peak RSS figures don't include each other.
+    """
+    logger = logging.getLogger(__name__)
+    raw_filepath = Path(os.path.join(PROJECT_DIR, "data", "raw", "song_lyrics.csv"))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if not os.path.exists(raw_filepath):
+            raw_filepath = os.path.join(tmpdir, "song_lyrics.csv")
+            synthetic_raw(n).to_csv(raw_filepath, index=False)
+        logger.info(f'benchmarking memory on {n} rows of {raw_filepath}')
+
+        ctx = multiprocessing.get_context("spawn")
+        results = []
+        for compact in (False, True):
+            with ctx.Pool(1) as pool:
+                results.append(pool.apply(_measure, (str(raw_filepath), n, compact)))
+
+    results = pd.DataFrame(results)
+    logger.info('\n' + results.to_string(index=False))
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchMemory()
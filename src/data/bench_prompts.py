@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+import numpy as np
+import pandas as pd
+from build_features import genre_mappings, lyrics_prompter, lyrics_prompts
+from bench_cleaning import synthetic_lyrics
+from cleaning import clean_lyrics
+
+SAMPLE_SIZE = 5 * (10**4)
+
+
+def synthetic_songs(n, seed=0):
+    """
+        Cleaned songs of every genre, with artists (some non-ascii) and years as stored by the pipeline.
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "cleaned_lyrics": clean_lyrics(synthetic_lyrics(n, seed)),
+        "tag": rng.choice(list(genre_mappings), n),
+        "artist": rng.choice(["Drake", "Beyoncé", "AC/DC", "Guns N' Roses", "50 Cent"], n),
+        "year": rng.integers(1981, 2023, n).astype(np.int16),
+    })
+
+
+def legacy_prompts(songs):
+    # build_features.py before the column-wise prompts
+    return songs.apply(lambda x: lyrics_prompter(x["cleaned_lyrics"], x["tag"], x["artist"], x["year"]), axis=1)
+
+
+def column_prompts(songs):
+    return lyrics_prompts(songs["cleaned_lyrics"], songs["tag"], songs["artist"], songs["year"])
+
+
+def _timed(func, songs, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        prompts = func(songs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return prompts, best
+
+
+def benchPrompts(n=SAMPLE_SIZE):
+    """
+        Checks that lyrics_prompts builds byte for byte the same prompts as lyrics_prompter
+        (with per-row and shared genres, artists and years, integer and float years)
+        and compares their rows/sec.
+    """
+    logger = logging.getLogger(__name__)
+    songs = synthetic_songs(n)
+    logger.info(f'benchmarking prompt construction on {len(songs)} rows')
+
+    legacy, legacy_seconds = _timed(legacy_prompts, songs)
+    column, column_seconds = _timed(column_prompts, songs)
+    results = pd.DataFrame([
+        {"prompts": "row-wise (legacy)", "rows": n, "seconds": legacy_seconds, "rows_per_sec": n / legacy_seconds},
+        {"prompts": "column-wise", "rows": n, "seconds": column_seconds, "rows_per_sec": n / column_seconds},
+    ])
+    logger.info('\n' + results.to_string(index=False))
+
+    mismatches = {"per-row values": int((legacy != column).sum())}
+
+    # single genre and artist, as build_features calls it
+    artist_songs = songs[(songs["tag"] == "rap") & (songs["artist"] == "Beyoncé")]
+    shared = lyrics_prompts(artist_songs["cleaned_lyrics"], "rap", "Beyoncé", artist_songs["year"])
+    expected = artist_songs.apply(lambda x: lyrics_prompter(x["cleaned_lyrics"], "rap", "Beyoncé", x["year"]), axis=1)
+    mismatches["shared values"] = int((shared != expected).sum())
+
+    float_songs = songs.astype({"year": float})
+    mismatches["float years"] = int((legacy_prompts(float_songs) != column_prompts(float_songs)).sum())
+
+    logger.info(f'mismatching prompts: {mismatches}')
+    if any(mismatches.values()):
+        raise ValueError(f"lyrics_prompts doesn't match lyrics_prompter: {mismatches}")
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchPrompts()
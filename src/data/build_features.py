@@ -1,7 +1,14 @@
 import os
-import re
+import logging
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from instrumentation import StageProfiler
+from matching import AhoCorasick
+from cleaning import clean_lyric_text, clean_lyrics
+from tokens import TokenShardWriter, TOKENS_DIR
+from storage import (dataset_columns, dataset_filepath, iter_dataset, write_chunk, remove_dataset, is_parquet,
+                     FEATURES_PARTITION, FEATURES_SCHEMA)
 
 genre_mappings = {
     "pop": "Pop",
@@ -12,28 +19,12 @@ genre_mappings = {
 }
 
 PROJECT_DIR = Path(__file__).resolve().parents[2]
+CHUNK_SIZE = 10**5
+TOP_SONGS = 300
 
 
 def clean_lyric_content(lyric_text):
-    try:
-        contributor_pattern = re.compile(
-            r'\d+ ContributorsTranslations.*?Lyrics')
-        bracket_pattern = re.compile(r'\[.*?\](?!\[s:|\[e:)')
-        ascii_pattern = re.compile(r'[^\x00-\x7F]+')
-        newline_pattern = re.compile(r'\n{3,}')
-
-        # Apply regex patterns
-        lyric_text = re.sub(contributor_pattern, '', lyric_text)
-        lyric_text = re.sub(bracket_pattern, '', lyric_text)
-        lyric_text = re.sub(ascii_pattern, ' ', lyric_text)
-        lyric_text = re.sub(newline_pattern, '\n\n', lyric_text)
-
-        # Removing quotation marks
-        lyric_text = lyric_text.replace('"', '')
-
-        return lyric_text.strip()
-    except:
-        return ""
+    return clean_lyric_text(lyric_text)
 
 
 def lyrics_prompter(lyrics, genre, artist, year):
@@ -43,46 +34,165 @@ def lyrics_prompter(lyrics, genre, artist, year):
     return prompted_lyric
 
 
-def process_lyrics_file(input_filepath, output_filepath, genres_artists):
-    # Read CSV file
-    df = pd.read_csv(input_filepath)
+def _as_text(values):
+    # as an f-string formats them, missing values included ("nan"), which astype(str) keeps missing
+    if not isinstance(values, pd.Series):
+        return str(values)
+    values = values.astype(object)
+    return values.map(str) if values.isna().any() else values.astype(str)
+
+
+def lyrics_prompts(lyrics, genres, artists, years):
+    """
+        Column-wise lyrics_prompter, producing the same strings: builds the prompts of a column of lyrics
+        from Series of genres, artists and years (or single values shared by every row),
+        mapping the genres to their names once instead of once per row.
+    """
+    if isinstance(genres, pd.Series):
+        genre_names = genres.astype(object).map(genre_mappings)
+        if genre_names.isna().any():
+            raise KeyError(f"Unknown genres {sorted(set(genres[genre_names.isna()]), key=str)}")
+    else:
+        genre_names = genre_mappings[genres]
+
+    prompts = ('[s:genre]' + genre_names + '[e:genre]' + ' ' + '[s:artist]' + _as_text(artists) + '[e:artist]' +
+               ' ' + '[s:year]' + _as_text(years) + '[e:year]' + ' ' +
+               '[s:lyrics] ' + _as_text(lyrics) + ' [e:lyrics]' + '\n')
+    return prompts.astype(object)
 
+
+def match_roster(df, genres_artists):
+    """
+        Returns the positions of the rows of df matching each (genre, artist) pair of the roster:
+        the rows of the genre whose artist contains the roster artist, ignoring case
+        (as df['artist'].str.contains(artist, case=False, regex=False) does).
+        Each distinct artist value is scanned once by an Aho-Corasick automaton of the whole roster,
+        so an artist value matching several roster artists is found for all of them.
+    """
+    pattern_ids = {}
+    for artists in genres_artists.values():
+        for artist in artists:
+            pattern_ids.setdefault(artist.upper(), len(pattern_ids))
+    matcher = AhoCorasick(pattern_ids)
+
+    artist_codes, artist_values = pd.factorize(df['artist'])
+    tag_codes, tag_values = pd.factorize(df['tag'].str.lower())
+    tag_ids = {tag: code for code, tag in enumerate(tag_values)}
+
+    # row positions grouped by artist value, in their original order
+    order = np.argsort(artist_codes, kind="stable")
+    bounds = np.searchsorted(artist_codes[order], np.arange(len(artist_values) + 1))
+    pattern_rows = [[] for _ in pattern_ids]
+    for value_idx, value in enumerate(artist_values):
+        for pattern_idx in matcher.search(str(value).upper()):
+            pattern_rows[pattern_idx].append(order[bounds[value_idx]:bounds[value_idx + 1]])
+
+    roster_rows = {}
+    for genre, artists in genres_artists.items():
+        genre_code = tag_ids.get(genre.lower(), -2)
+        for artist in artists:
+            rows = pattern_rows[pattern_ids[artist.upper()]]
+            rows = np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.intp)
+            roster_rows[(genre, artist)] = rows[tag_codes[rows] == genre_code]
+    return roster_rows
+
+
+def top_views(best, rows, n=TOP_SONGS):
+    """
+        Merges new rows into the `best` rows found so far (None at first) and keeps the n most viewed.
+        As the earlier rows come first, ties keep the rows that came first in the input,
+        so the result is the same as nlargest(n, 'views') over all the rows at once.
+    """
+    if best is not None:
+        rows = pd.concat([best, rows])
+    return rows.nlargest(min(n, len(rows)), 'views')
+
+
+def process_lyrics_file(input_filepath, output_filepath, genres_artists, chunksize=CHUNK_SIZE, tokens_dirpath=None):
+    """
+        Builds the prompts of the TOP_SONGS most viewed songs of every artist in the roster.
+        With tokens_dirpath, the prompts are also tokenized in batches (GPT-2 with the special tokens of training)
+        and saved there as uint16 token shards, in the order they are written, which training memory maps.
+    """
     # Check for required columns
-    if not all(col in df.columns for col in ['artist', 'tag', 'views', 'lyrics', 'year']):
+    if not all(col in dataset_columns(input_filepath) for col in ['artist', 'tag', 'views', 'lyrics', 'year']):
         raise ValueError("Required columns are missing from the input file")
-    else:
-        df = df[['title', 'artist', 'tag', 'year', 'views', 'lyrics']]
 
-    final_lyrics_df = pd.DataFrame(columns=[
-                                   'title', 'artist', 'tag', 'year', 'views', 'lyrics', "cleaned_lyrics", "final_lyrics"])
+    logger = logging.getLogger(__name__)
+    profiler = StageProfiler("build_features")
+    columns = ['title', 'artist', 'tag', 'year', 'views', 'lyrics']
+
+    # Stream the needed columns of the genres in the roster (whatever the case of their tags, as match_roster
+    # compares them), keeping only the most viewed songs of every artist seen so far, so at most
+    # TOP_SONGS rows per artist (plus a chunk) are in memory
+    top_rows = {}
+    chunks = iter_dataset(input_filepath, columns=columns, chunksize=chunksize,
+                          filters=[('tag', 'in', list(genres_artists))], ignore_case=['tag'])
+    for idx, df in enumerate(profiler.iterate("read", chunks)):
+        # Find the rows of every artist of the roster in a single pass
+        with profiler.stage("match_artist", idx, len(df)) as stage:
+            roster_rows = match_roster(df, genres_artists)
+            stage["rows_out"] = sum(len(rows) for rows in roster_rows.values())
+
+        with profiler.stage("top_songs", idx, stage["rows_out"]) as stage:
+            for pair, rows in roster_rows.items():
+                if len(rows):
+                    top_rows[pair] = top_views(top_rows.get(pair), df.iloc[rows])
+            stage["rows_out"] = sum(len(rows) for rows in top_rows.values())
+
+    remove_dataset(output_filepath)
+    part_idx = 0
+    token_writer = TokenShardWriter(tokens_dirpath) if tokens_dirpath is not None else None
 
     for genre, artists in genres_artists.items():
-        genre_df = df[df['tag'].str.lower() == genre.lower()]
         for artist in artists:
-            artist_df = genre_df[genre_df['artist'].str.contains(
-                artist, case=False, regex=False)]
-            top_songs = artist_df.nlargest(min(300, len(artist_df)), 'views')
+            chunk = f"{genre}/{artist}"
+            top_songs = top_rows.get((genre, artist), pd.DataFrame(columns=columns))
 
             # Clean lyrics
-            top_songs['cleaned_lyrics'] = top_songs['lyrics'].apply(
-                clean_lyric_content)
-            top_songs = top_songs.dropna()
+            with profiler.stage("clean_lyrics", chunk, len(top_songs)) as stage:
+                top_songs['cleaned_lyrics'] = clean_lyrics(top_songs['lyrics'])
+                top_songs = top_songs.dropna()
+                stage["rows_out"] = len(top_songs)
 
             # Prepare tags and combine
-            top_songs['final_lyrics'] = top_songs.apply(lambda x: lyrics_prompter(
-                x["cleaned_lyrics"], genre, artist, x["year"]), axis=1)
+            with profiler.stage("prompt", chunk, len(top_songs)) as stage:
+                top_songs['final_lyrics'] = lyrics_prompts(
+                    top_songs["cleaned_lyrics"], genre, artist, top_songs["year"])
+                stage["rows_out"] = len(top_songs)
+
+            if len(top_songs):
+                with profiler.stage("write", chunk, len(top_songs)) as stage:
+                    write_chunk(top_songs, output_filepath, part_idx,
+                                partition_col=FEATURES_PARTITION, schema=FEATURES_SCHEMA)
+                    part_idx += 1
+                    stage["rows_out"] = len(top_songs)
+
+                if token_writer is not None:
+                    with profiler.stage("tokenize", chunk, len(top_songs)) as stage:
+                        token_writer.add(top_songs['final_lyrics'])
+                        stage["rows_out"] = len(top_songs)
+
+    if part_idx == 0 and not is_parquet(output_filepath):
+        pd.DataFrame(columns=['title', 'artist', 'tag', 'year', 'views', 'lyrics', "cleaned_lyrics", "final_lyrics"]).to_csv(
+            output_filepath, index=False)
 
-            final_lyrics_df = pd.concat(
-                [final_lyrics_df, top_songs], ignore_index=True)
+    if token_writer is not None:
+        meta = token_writer.close()
+        logger.info(f"{meta['documents']} prompts tokenized into {meta['tokens']} tokens in {tokens_dirpath}")
 
-    final_lyrics_df.to_csv(output_filepath, index=False)
+    logger.info(f'saved profiling of every step in {profiler.save()}')
+    logger.info('\n' + profiler.summary().to_string(index=False))
 
 
 if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
 
-    # File paths
-    input_filepath = Path(os.path.join(
-        PROJECT_DIR, "data", "processed", "lyrics_processed.csv"))
+    # File paths, the processed data set as make_processed.py wrote it (Parquet or csv)
+    input_filepath = dataset_filepath("processed", "lyrics_processed", "parquet")
+    if not os.path.exists(input_filepath):
+        input_filepath = dataset_filepath("processed", "lyrics_processed", "csv")
     output_filepath = Path(os.path.join(
         PROJECT_DIR, "data", "features", "lyrics_features.csv"))
     genres_artists = {'rap': {'21 Savage',
@@ -256,5 +366,5 @@ if __name__ == "__main__":
                                'U2',
                                'Weezer'}}
 
-    # Process lyrics
-    process_lyrics_file(input_filepath, output_filepath, genres_artists)
+    # Process lyrics, exporting the token shards training memory maps
+    process_lyrics_file(input_filepath, output_filepath, genres_artists, tokens_dirpath=TOKENS_DIR)
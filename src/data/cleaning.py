@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import re
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Patterns are compiled once here and shared by make_processed.py and build_features.py.
+
+# section headers such as "[Chorus]" on a line of their own, also run by Arrow (RE2 reads it the same)
+SECTION_HEADER_REGEX = r"(?m)^\[.*?\]$"
+SECTION_HEADER_PATTERN = re.compile(SECTION_HEADER_REGEX)
+
+CONTRIBUTOR_PATTERN = re.compile(r'\d+ ContributorsTranslations.*?Lyrics')
+BRACKET_PATTERN = re.compile(r'\[.*?\](?!\[s:|\[e:)')
+NON_ASCII_PATTERN = re.compile(r'[^\x00-\x7F]+')
+NEWLINES_PATTERN = re.compile(r'\n{3,}')
+
+
+def clean_raw_lyric(lyric_text):
+    """
+        Removes section header lines and puts the lyrics on a single line.
+    """
+    if not isinstance(lyric_text, str):
+        return lyric_text
+    if "[" in lyric_text:
+        lyric_text = SECTION_HEADER_PATTERN.sub("", lyric_text)
+    return lyric_text.replace("\n", " ")
+
+
+def clean_lyric_text(lyric_text):
+    """
+        Removes the Genius contributors header, bracketed annotations, non-ascii characters,
+        extra empty lines and quotation marks. Anything that isn't a string cleans to "".
+    """
+    if not isinstance(lyric_text, str):
+        return ""
+    # each pattern only runs when a cheap literal check shows it can match
+    if 'ContributorsTranslations' in lyric_text:
+        lyric_text = CONTRIBUTOR_PATTERN.sub('', lyric_text)
+    if '[' in lyric_text:
+        lyric_text = BRACKET_PATTERN.sub('', lyric_text)
+    if not lyric_text.isascii():
+        lyric_text = NON_ASCII_PATTERN.sub(' ', lyric_text)
+    if '\n\n\n' in lyric_text:
+        lyric_text = NEWLINES_PATTERN.sub('\n\n', lyric_text)
+    return lyric_text.replace('"', '').strip()
+
+
+def clean_raw_lyrics(lyrics):
+    """
+        Column-wise clean_raw_lyric. Arrow backed text, which make_processed.py reads, is cleaned by
+        Arrow's compute kernels without going through Python strings (twice as fast as one pass of
+        clean_raw_lyric over it), other columns in one pass instead of one per regex.
+    """
+    if isinstance(lyrics.dtype, pd.StringDtype) and lyrics.dtype.storage == "pyarrow":
+        text = pc.replace_substring_regex(pa.array(lyrics.array), SECTION_HEADER_REGEX, "")
+        return pd.Series(pd.array(pc.replace_substring(text, "\n", " "), dtype=lyrics.dtype), index=lyrics.index)
+    return pd.Series([clean_raw_lyric(text) for text in lyrics], index=lyrics.index, dtype=lyrics.dtype)
+
+
+def clean_lyrics(lyrics):
+    """
+        Column-wise clean_lyric_text: one pass over the column instead of one per regex.
+    """
+    return pd.Series([clean_lyric_text(text) for text in lyrics], index=lyrics.index, dtype=object)
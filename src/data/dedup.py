@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pandas as pd
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def key_hashes(df, columns):
+    """
+        Hashes the `columns` of every row of df into a single 64-bit key.
+        The hashes are stable across processes and runs, so they can be persisted.
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy(dtype=np.uint64)
+
+
+class HashIndex:
+    """
+        A compact set of 64-bit hashes for streaming deduplication.
+
+        Keys live in a large sorted numpy array plus a small sorted array of recent
+        insertions that is merged in once it outgrows a fraction of the large one,
+        so memory stays at 8 bytes per distinct key and lookups are binary searches.
+    """
+
+    def __init__(self, keys=None, merge_ratio=0.125, min_merge_size=2**16):
+        self.keys = np.unique(np.asarray(keys, dtype=np.uint64)) if keys is not None else np.empty(0, dtype=np.uint64)
+        self.recent = np.empty(0, dtype=np.uint64)
+        self.merge_ratio = merge_ratio
+        self.min_merge_size = min_merge_size
+
+    def __len__(self):
+        return len(self.keys) + len(self.recent)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.recent.nbytes
+
+    def contains(self, hashes):
+        """
+            Returns a boolean mask of the hashes that are already in the index.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        return _isin_sorted(hashes, self.keys) | _isin_sorted(hashes, self.recent)
+
+    def add(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        self.recent = np.union1d(self.recent, hashes)
+        if len(self.recent) > max(self.min_merge_size, self.merge_ratio * len(self.keys)):
+            self.keys = np.union1d(self.keys, self.recent)
+            self.recent = np.empty(0, dtype=np.uint64)
+
+    def first_unseen(self, hashes):
+        """
+            Returns a mask keeping the first occurrence of every hash that is not in the index yet
+            (the streaming equivalent of drop_duplicates), without adding them.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        mask = np.zeros(len(hashes), dtype=bool)
+        mask[np.unique(hashes, return_index=True)[1]] = True
+        return mask & ~self.contains(hashes)
+
+    def keep_first_seen(self, hashes):
+        """
+            Returns the first_unseen mask of hashes and adds the kept hashes to the index.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        mask = self.first_unseen(hashes)
+        self.add(hashes[mask])
+        return mask
+
+    def save(self, filepath):
+        """
+            Persists the index as a single .npy file, replacing any previous one atomically.
+        """
+        tmp_filepath = f"{filepath}.tmp"
+        with open(tmp_filepath, "wb") as f:
+            np.save(f, np.union1d(self.keys, self.recent))
+        os.replace(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, filepath, **kwargs):
+        return cls(np.load(filepath), **kwargs)
+
+
+def _isin_sorted(hashes, keys):
+    if len(keys) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    pos = np.searchsorted(keys, hashes)
+    pos[pos == len(keys)] = 0
+    return keys[pos] == hashes
+
+
+def lsh_params(threshold, num_perm, false_positive_weight=0.5, false_negative_weight=0.5):
+    """
+        Picks the number of bands and rows per band for num_perm permutations that minimise
+        the weighted probability of false positives and false negatives around threshold.
+    """
+    xs = np.linspace(0, 1, 1001)
+    below, above = xs[xs <= threshold], xs[xs >= threshold]
+    best, best_error = None, np.inf
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positives = (1 - (1 - below**rows) ** bands).mean() * threshold
+            false_negatives = ((1 - above**rows) ** bands).mean() * (1 - threshold)
+            error = false_positive_weight * false_positives + false_negative_weight * false_negatives
+            if error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+class MinHasher:
+    """
+        Computes MinHash signatures of word n-gram shingles and their LSH band hashes.
+        It only holds the permutations, so it is cheap to send to worker processes.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, ngram=5, seed=1, batch_shingles=2**14):
+        if not 0 < threshold < 1:
+            raise ValueError("threshold must be between 0 and 1")
+        gen = np.random.RandomState(seed)
+        self.a = gen.randint(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = gen.randint(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.ngram = ngram
+        self.batch_shingles = batch_shingles
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+
+    def _shingles(self, text):
+        words = text.lower().split() if isinstance(text, str) else []
+        if len(words) <= self.ngram:
+            return [" ".join(words)]
+        return [" ".join(words[i:i + self.ngram]) for i in range(len(words) - self.ngram + 1)]
+
+    def signatures(self, texts):
+        """
+            Returns an (n_texts, num_perm) uint32 array of MinHash signatures.
+            Shingles of several texts are hashed and permuted together in bounded batches.
+        """
+        signatures = np.full((len(texts), self.num_perm), MAX_HASH, dtype=np.uint64)
+        shingles, doc_ids = [], []
+        for i, text in enumerate(texts):
+            text_shingles = self._shingles(text)
+            shingles.extend(text_shingles)
+            doc_ids.extend([i] * len(text_shingles))
+            if len(shingles) >= self.batch_shingles:
+                self._update(signatures, shingles, doc_ids)
+                shingles, doc_ids = [], []
+        if shingles:
+            self._update(signatures, shingles, doc_ids)
+        return signatures.astype(np.uint32)
+
+    def _update(self, signatures, shingles, doc_ids):
+        hashes = pd.util.hash_array(np.asarray(shingles, dtype=object)) & MAX_HASH
+        # (a * x + b) mod p, the product wraps around 2**64 like other numpy MinHash implementations
+        permuted = ((hashes[:, None] * self.a + self.b) % MERSENNE_PRIME) & MAX_HASH
+
+        doc_ids = np.asarray(doc_ids)
+        starts = np.flatnonzero(np.r_[True, doc_ids[1:] != doc_ids[:-1]])
+        docs = doc_ids[starts]
+        signatures[docs] = np.minimum(signatures[docs], np.minimum.reduceat(permuted, starts, axis=0))
+
+    def band_hashes(self, texts):
+        """
+            Returns an (n_texts, bands) uint64 array, one hash per LSH band of each signature.
+        """
+        return band_hashes(self.signatures(texts), self.bands, self.rows)
+
+
+def band_hashes(signatures, bands, rows):
+    """
+        Hashes each of the bands of rows values of MinHash signatures into an (n_texts, bands) uint64 array.
+    """
+    hashes = np.empty((len(signatures), bands), dtype=np.uint64)
+    if len(signatures) == 0:
+        return hashes
+    for band in range(bands):
+        values = pd.DataFrame(signatures[:, band * rows:(band + 1) * rows])
+        hashes[:, band] = pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+    return hashes
+
+
+def _sorted_merge(keys, ids, new_keys, new_ids):
+    keys, ids = np.concatenate([keys, new_keys]), np.concatenate([ids, new_ids])
+    order = np.argsort(keys, kind="stable")
+    return keys[order], ids[order]
+
+
+def _lookup_sorted(keys, ids, hashes):
+    """
+        The (position in hashes, id) pairs of every key of the sorted keys equal to one of hashes.
+    """
+    begins, ends = np.searchsorted(keys, hashes, "left"), np.searchsorted(keys, hashes, "right")
+    counts = ends - begins
+    queries = np.repeat(np.arange(len(hashes)), counts)
+    # the positions begins[q], begins[q] + 1, ..., ends[q] - 1 of every query q, in one array
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(begins, counts)
+    return queries, ids[positions]
+
+
+class LSHIndex:
+    """
+        Streaming near-duplicate filter over the MinHash signatures of texts.
+        The texts sharing an LSH band with a text are only candidates, it is a near-duplicate of one of them
+        when their estimated Jaccard similarity (the share of equal signature values) reaches threshold.
+        Every band keeps its hashes sorted, with the ids of their texts, in a large array plus a small one
+        of recent insertions (as HashIndex does), and the uint32 signatures of the indexed texts are kept
+        to compare candidates with: 12 bytes per band plus 4 per permutation per indexed text.
+    """
+
+    def __init__(self, bands, rows, threshold, merge_ratio=0.125, min_merge_size=2**16):
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+        self.merge_ratio = merge_ratio
+        self.min_merge_size = min_merge_size
+        self.keys = [np.empty(0, dtype=np.uint64) for _ in range(bands)]
+        self.ids = [np.empty(0, dtype=np.uint32) for _ in range(bands)]
+        self.recent_keys = [np.empty(0, dtype=np.uint64) for _ in range(bands)]
+        self.recent_ids = [np.empty(0, dtype=np.uint32) for _ in range(bands)]
+        self.signatures = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return (sum(array.nbytes for arrays in (self.keys, self.ids, self.recent_keys, self.recent_ids)
+                    for array in arrays)
+                + (self.signatures[:self.count].nbytes if self.count else 0))
+
+    def add(self, signatures):
+        """
+            Indexes the texts of signatures without looking for near-duplicates among them.
+        """
+        signatures = np.asarray(signatures, dtype=np.uint32)
+        self._add(signatures, band_hashes(signatures, self.bands, self.rows))
+
+    def _add(self, signatures, hashes):
+        ids = np.arange(self.count, self.count + len(signatures), dtype=np.uint32)
+        # grown by doubling, so every signature is copied a bounded number of times
+        capacity = 0 if self.signatures is None else len(self.signatures)
+        if self.count + len(signatures) > capacity:
+            grown = np.empty((max(2 * capacity, self.count + len(signatures)), signatures.shape[1]), dtype=np.uint32)
+            if self.count:
+                grown[:self.count] = self.signatures[:self.count]
+            self.signatures = grown
+        self.signatures[self.count:self.count + len(signatures)] = signatures
+        self.count += len(signatures)
+        for band in range(self.bands):
+            self.recent_keys[band], self.recent_ids[band] = _sorted_merge(
+                self.recent_keys[band], self.recent_ids[band], hashes[:, band], ids)
+            if len(self.recent_keys[band]) > max(self.min_merge_size, self.merge_ratio * len(self.keys[band])):
+                self.keys[band], self.ids[band] = _sorted_merge(
+                    self.keys[band], self.ids[band], self.recent_keys[band], self.recent_ids[band])
+                self.recent_keys[band] = np.empty(0, dtype=np.uint64)
+                self.recent_ids[band] = np.empty(0, dtype=np.uint32)
+
+    def _similar(self, signatures, others):
+        # the estimated Jaccard similarity is the share of the permutations whose minimum is the same
+        return (signatures == others).mean(axis=-1) >= self.threshold
+
+    def keep_first_seen(self, signatures):
+        """
+            Returns a mask of the texts of the (n_texts, num_perm) signatures that are no near-duplicate
+            of an indexed text or of an earlier kept text of signatures, then indexes the kept ones.
+            The index then only holds kept texts, whatever the texts were compared with before,
+            so a near-duplicate of a dropped text that is no near-duplicate of a kept one is kept.
+        """
+        signatures = np.asarray(signatures, dtype=np.uint32)
+        hashes = band_hashes(signatures, self.bands, self.rows)
+        duplicated = np.zeros(len(signatures), dtype=bool)
+
+        # candidates among the indexed texts, compared all at once
+        for band in range(self.bands if self.count else 0):
+            for keys, ids in ((self.keys[band], self.ids[band]), (self.recent_keys[band], self.recent_ids[band])):
+                queries, candidates = _lookup_sorted(keys, ids, hashes[:, band])
+                duplicated[queries[self._similar(signatures[queries], self.signatures[candidates])]] = True
+
+        # candidates among the earlier kept texts of signatures, in order
+        seen = [{} for _ in range(self.bands)]
+        for i in range(len(signatures)):
+            for band in range(self.bands):
+                earlier = seen[band].get(hashes[i, band])
+                if earlier and not duplicated[i]:
+                    duplicated[i] = self._similar(signatures[i], signatures[earlier]).any()
+            if not duplicated[i]:
+                for band in range(self.bands):
+                    seen[band].setdefault(hashes[i, band], []).append(i)
+
+        self._add(signatures[~duplicated], hashes[~duplicated])
+        return ~duplicated
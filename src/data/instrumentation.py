@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+PROFILE_DIR = Path(os.path.join(PROJECT_DIR, "reports", "profiling"))
+
+
+def peak_rss_mb():
+    """
+        Peak resident set size of this process in MiB, since the last reset_peak_rss or else so far
+        (None where it can't be measured). Read from VmHWM in /proc/self/status, else getrusage.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def reset_peak_rss():
+    """
+        Resets the peak resident set size (VmHWM) of this process to its current one by writing 5 to
+        /proc/self/clear_refs (Linux). Returns whether it could.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def rss_mb():
+    """
+        Current resident set size of this process in MiB (None where /proc isn't available).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _RSSSampler(threading.Thread):
+    # the largest resident set size seen every interval seconds, until stopped
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_mb = rss_mb()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, rss_mb())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak_mb = max(self.peak_mb, rss_mb())
+        return self.peak_mb
+
+
+class StageProfiler:
+    """
+        Records the wall time, rows in and out and memory of every stage of every chunk of a pipeline.
+        Records are plain dicts so the ones made in worker processes can be sent back and merged.
+        peak_rss_mb is the peak resident set size of the process during the stage: where /proc/self/clear_refs
+        can be written (Linux), the high-water mark is reset when the stage starts and read when it ends,
+        else the resident set size is sampled every 10ms during the stage, which can miss shorter spikes.
+        Without /proc at all it is the peak of the process so far. peak_rss_method says which is used
+        ("clear_refs", "sampled" or "process").
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.records = []
+        self.peak_rss_method = "clear_refs" if reset_peak_rss() else "sampled" if rss_mb() is not None else "process"
+        # the stages running, whose peaks so far a nested stage's reset would lose
+        self._running = []
+
+    @contextmanager
+    def stage(self, name, chunk, rows_in):
+        """
+            Times the stage run inside the with block, which should set record["rows_out"].
+        """
+        record = {"stage": name, "chunk": chunk, "rows_in": rows_in, "rows_out": None}
+        run = self._start()
+        try:
+            yield record
+        finally:
+            self._finish(record, run)
+
+    def iterate(self, name, iterable):
+        """
+            Yields the items of iterable (chunks of rows), recording the time taken to produce each one as stage `name`.
+        """
+        iterator = iter(iterable)
+        for idx in itertools.count():
+            run = self._start()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._stop(run)
+                return
+            except BaseException:
+                self._stop(run)
+                raise
+            self._finish({"stage": name, "chunk": idx, "rows_in": len(item), "rows_out": len(item)}, run)
+            yield item
+
+    def _start(self):
+        run = {"peak_rss_mb": 0.0}
+        if self.peak_rss_method == "clear_refs":
+            peak = peak_rss_mb()
+            for running in self._running:
+                running["peak_rss_mb"] = max(running["peak_rss_mb"], peak)
+            reset_peak_rss()
+        elif self.peak_rss_method == "sampled":
+            run["sampler"] = _RSSSampler()
+            run["sampler"].start()
+        self._running.append(run)
+        run["start"] = time.perf_counter()
+        return run
+
+    def _stop(self, run):
+        # the peak resident set size during the run
+        self._running = [running for running in self._running if running is not run]
+        if self.peak_rss_method == "clear_refs":
+            return max(run["peak_rss_mb"], peak_rss_mb())
+        if self.peak_rss_method == "sampled":
+            return run["sampler"].stop()
+        return peak_rss_mb()
+
+    def _finish(self, record, run):
+        record["seconds"] = time.perf_counter() - run["start"]
+        peak = self._stop(run)
+        record["rss_mb"] = rss_mb()
+        record["peak_rss_mb"] = peak
+        record["pid"] = os.getpid()
+        self.records.append(record)
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def summary(self):
+        """
+            Per stage totals, in the order the stages first ran.
+        """
+        records = pd.DataFrame(self.records)
+        if records.empty:
+            return records
+        summary = records.groupby("stage", sort=False).agg(
+            chunks=("chunk", "count"),
+            seconds=("seconds", "sum"),
+            rows_in=("rows_in", "sum"),
+            rows_out=("rows_out", "sum"),
+            peak_rss_mb=("peak_rss_mb", "max"),
+        )
+        summary["share"] = summary["seconds"] / summary["seconds"].sum()
+        return summary.reset_index()
+
+    def save(self, dirpath=PROFILE_DIR):
+        """
+            Writes every record to <pipeline>_stages.csv and the per stage summary to <pipeline>_summary.json.
+        """
+        os.makedirs(dirpath, exist_ok=True)
+        pd.DataFrame(self.records).to_csv(os.path.join(dirpath, f"{self.pipeline}_stages.csv"), index=False)
+        with open(os.path.join(dirpath, f"{self.pipeline}_summary.json"), "w") as f:
+            json.dump(self.summary().to_dict(orient="records"), f, indent=4)
+        return dirpath
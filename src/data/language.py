@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+LANGUAGE_CACHE_DIR = Path(os.path.join(PROJECT_DIR, "data", "processed", "language_cache"))
+MODEL_CKPT = "papluca/xlm-roberta-base-language-detection"
+
+# label of lyrics the heuristic is sure are not english, without telling which language they are in
+OTHER_LANGUAGE = "other"
+
+ENGLISH_STOPWORDS = frozenset("""
+    i me my you your we our he she it they them the a an and or but if so to of in on at for with
+    is are was be been am do don't i'm it's that this what when all no not just like know can
+    get got up down oh yeah love baby
+""".split())
+
+# one classifier per process, loaded on first use
+_PIPELINES = {}
+# one cache per process and directory, shared by every detector using it
+_CACHES = {}
+
+
+def heuristic_language(lyric_text):
+    """
+        Cheap guess of the language of a lyric: "en" when it is plainly english, OTHER_LANGUAGE when
+        it is mostly written in a non-latin script, "" (unknown) when there is no text
+        and None when the classifier has to decide.
+    """
+    if not isinstance(lyric_text, str) or not lyric_text.strip():
+        return ""
+    if not lyric_text.isascii():
+        non_ascii = sum(not c.isascii() for c in lyric_text) / len(lyric_text)
+        if non_ascii > 0.3:
+            return OTHER_LANGUAGE
+        if non_ascii > 0.02:
+            return None
+    words = lyric_text.lower().split()[:200]
+    if words and sum(word in ENGLISH_STOPWORDS for word in words) / len(words) >= 0.25:
+        return "en"
+    return None
+
+
+class LanguageCache:
+    """
+        On-disk cache of classifier labels keyed by the 64-bit hash of the lyric text.
+        Entries are kept as sorted uint64 keys and uint8 label codes, and stored as .npz shards
+        (one per processed chunk, so worker processes never write to the same file) that compact() merges.
+    """
+
+    def __init__(self, dirpath=LANGUAGE_CACHE_DIR):
+        self.dirpath = Path(dirpath)
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.codes = np.empty(0, dtype=np.uint8)
+        self.vocab = []
+        for filepath in sorted(glob.glob(os.path.join(self.dirpath, "*.npz"))):
+            with np.load(filepath) as shard:
+                self._merge(shard["keys"], np.asarray(shard["vocab"])[shard["codes"]].tolist())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _encode(self, labels):
+        for label in labels:
+            if label not in self.vocab:
+                self.vocab.append(label)
+        return np.array([self.vocab.index(label) for label in labels], dtype=np.uint8)
+
+    def _merge(self, keys, labels):
+        keys = np.asarray(keys, dtype=np.uint64)
+        keys, first = np.unique(keys, return_index=True)
+        codes = self._encode(labels)[first] if len(keys) else np.empty(0, dtype=np.uint8)
+        new = ~np.isin(keys, self.keys)
+        order = np.argsort(np.concatenate([self.keys, keys[new]]), kind="stable")
+        self.keys = np.concatenate([self.keys, keys[new]])[order]
+        self.codes = np.concatenate([self.codes, codes[new]])[order]
+
+    def lookup(self, hashes):
+        """
+            Returns the cached labels of hashes, None where they aren't cached.
+        """
+        labels = np.full(len(hashes), None, dtype=object)
+        if len(self.keys) == 0:
+            return labels
+        pos = np.searchsorted(self.keys, hashes)
+        pos[pos == len(self.keys)] = 0
+        hit = self.keys[pos] == hashes
+        labels[hit] = np.asarray(self.vocab, dtype=object)[self.codes[pos[hit]]]
+        return labels
+
+    def add(self, hashes, labels, shard_name):
+        """
+            Caches the labels of hashes and saves them in the shard `shard_name`.
+        """
+        self._merge(hashes, labels)
+        os.makedirs(self.dirpath, exist_ok=True)
+        vocab = sorted(set(labels))
+        codes = np.array([vocab.index(label) for label in labels], dtype=np.uint8)
+        _save_npz(self.dirpath / f"{shard_name}.npz", keys=np.asarray(hashes, dtype=np.uint64),
+                  codes=codes, vocab=np.array(vocab))
+
+    def compact(self):
+        """
+            Merges every shard into a single one.
+        """
+        shards = glob.glob(os.path.join(self.dirpath, "*.npz"))
+        if not shards:
+            return
+        _save_npz(self.dirpath / "cache.npz", keys=self.keys, codes=self.codes, vocab=np.array(self.vocab))
+        for filepath in shards:
+            if Path(filepath).name != "cache.npz":
+                os.remove(filepath)
+
+
+def _save_npz(filepath, **arrays):
+    tmp_filepath = f"{filepath}.tmp"
+    with open(tmp_filepath, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_filepath, filepath)
+
+
+class LanguageDetector:
+    """
+        Labels the language of lyrics: the heuristic settles the plain cases, the cache answers lyrics
+        classified before and only the remaining ones go through the classifier, in batches of
+        lyrics truncated to max_chars characters before tokenization.
+        Lyrics the classifier isn't confident about (score below threshold) are labelled NaN.
+        It only holds its settings, so it is cheap to send to worker processes.
+    """
+
+    def __init__(self, cache_dirpath=LANGUAGE_CACHE_DIR, model_ckpt=MODEL_CKPT, batch_size=64,
+                 max_chars=512, max_length=128, threshold=0.5, device=-1):
+        self.cache_dirpath = Path(cache_dirpath)
+        self.model_ckpt = model_ckpt
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        self.max_length = max_length
+        self.threshold = threshold
+        self.device = device
+
+    @property
+    def cache(self):
+        if self.cache_dirpath not in _CACHES:
+            _CACHES[self.cache_dirpath] = LanguageCache(self.cache_dirpath)
+        return _CACHES[self.cache_dirpath]
+
+    @property
+    def pipe(self):
+        key = (self.model_ckpt, self.device)
+        if key not in _PIPELINES:
+            from transformers import pipeline
+            _PIPELINES[key] = pipeline("text-classification", model=self.model_ckpt, device=self.device)
+        return _PIPELINES[key]
+
+    def classify(self, texts):
+        texts = [text[:self.max_chars] for text in texts]
+        results = self.pipe(texts, batch_size=self.batch_size, truncation=True, max_length=self.max_length)
+        return ["" if res["score"] <= self.threshold else res["label"] for res in results]
+
+    def detect(self, lyrics, shard_name):
+        """
+            Returns the language labels of the lyrics Series, saving new classifications in the cache shard `shard_name`.
+        """
+        logger = logging.getLogger(__name__)
+        labels = np.array([heuristic_language(text) for text in lyrics], dtype=object)
+
+        ambiguous = np.flatnonzero(pd.isna(labels))
+        if len(ambiguous):
+            hashes = pd.util.hash_array(lyrics.to_numpy(dtype=object)[ambiguous])
+            labels[ambiguous] = self.cache.lookup(hashes)
+
+            missing = pd.isna(labels[ambiguous])
+            logger.info(f"{len(labels) - len(ambiguous)} lyrics settled by the heuristic, "
+                        f"{len(ambiguous) - missing.sum()} by the cache and {missing.sum()} by the classifier")
+            if missing.any():
+                texts = lyrics.iloc[ambiguous[missing]].tolist()
+                new_labels = self.classify(texts)
+                labels[ambiguous[missing]] = new_labels
+                self.cache.add(hashes[missing], new_labels, shard_name)
+
+        # unknown languages and unconfident classifications are labelled (and cached) as ""
+        return pd.Series(labels, index=lyrics.index).replace("", np.nan)
@@ -2,30 +2,216 @@
 import os
 import logging
 import pandas as pd
-import numpy as np
 from pathlib import Path
-# from transformers import pipeline
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import gc
+from contextlib import closing
+import pyarrow as pa
+import pyarrow.compute as pc
+from storage import (dataset_filepath, write_chunk, iter_dataset, iter_csv_tables, to_compact_pandas, csv_dtypes,
+                     ChunkJournal, PROCESSED_PARTITION, PROCESSED_SCHEMA)
+from cleaning import clean_raw_lyrics
+from instrumentation import StageProfiler
+from dedup import HashIndex, MinHasher, LSHIndex, key_hashes
+from language import LanguageDetector, LanguageCache
 
-# model_ckpt = "papluca/xlm-roberta-base-language-detection"
-# pipe = pipeline("text-classification", model=model_ckpt, device=-1)
 PROJECT_DIR = Path(__file__).resolve().parents[2]
+CHUNK_SIZE = 5 * (10**3)
+DEDUP_KEY = ["song", "artist", "year"]
+RAW_COLUMNS = ["title", "artist", "year", "tag", "lyrics"]
+READERS = ("pandas", "arrow")
 
-# def identify_language(lyrics: str) -> str|np.nan:
-#     res = pipe([lyrics], truncation=True, max_length=128)
-#     return res[0]['label'] if res[0]['score'] > 0.5 else np.nan
+
+def process_chunk(chunk, idx, minhasher=None, language_detector=None):
+    """ 
+        Filters and cleans a single chunk of the raw data (keeping english lyrics only when
+        a language_detector is given) and returns it ready to be appended to the processed data set, along with
+        the MinHash signatures of its lyrics when a minhasher is given (None otherwise)
+        and the profiling records of every step.
+    """
+    logger = logging.getLogger(__name__)
+    profiler = StageProfiler("make_processed")
+
+    logger.info(f"Processing chunk {idx}...")
+
+    # drop N.A. lyrics
+    logger.info(f"dropping N.A. lyrics from chunk {idx}...")
+    with profiler.stage("dropna", idx, len(chunk)) as stage:
+        chunk = chunk.dropna(subset=["lyrics"])
+        stage["rows_out"] = len(chunk)
+    
+    # drop romanizations
+    logger.info(f"dropping romanizations from chunk {idx}...")
+    with profiler.stage("romanizations", idx, len(chunk)) as stage:
+        chunk = chunk[chunk["artist"] != "Genius Romanizations"]
+        chunk = chunk[~chunk["title"].str.contains(r"\(?romanized\)?", regex=True, na=False, case=False)]
+        stage["rows_out"] = len(chunk)
+
+    # remove invalid years
+    logger.info(f"removing invalid years from chunk {idx}...")
+    with profiler.stage("years", idx, len(chunk)) as stage:
+        chunk = chunk[chunk['year'] > 1980]
+        chunk = chunk[chunk["year"] < 2023]
+        stage["rows_out"] = len(chunk)
+    
+    # remove duplicated entries
+    logger.info(f"removing duplicated entries from chunk {idx}...")
+    with profiler.stage("duplicates", idx, len(chunk)) as stage:
+        chunk = chunk.drop_duplicates(subset=["title", "artist", "year"])
+        stage["rows_out"] = len(chunk)
+    
+    # remove special characters and empty lines from lyrics
+    logger.info(f"removing special characters and empty lines from lyrics in chunk {idx}...")
+    with profiler.stage("clean_lyrics", idx, len(chunk)) as stage:
+        chunk["lyrics"] = clean_raw_lyrics(chunk["lyrics"])
+        stage["rows_out"] = len(chunk)
+
+    # drop lyrics that are too short or too long
+    logger.info(f"dropping lyrics that are too short or too long from chunk {idx}...")
+    with profiler.stage("lyrics_length", idx, len(chunk)) as stage:
+        chunk = chunk[chunk["lyrics"].str.len().between(10**2, 10**4)]
+        stage["rows_out"] = len(chunk)
+
+    # Dropping the views column and renaming the tag and title columns
+    logger.info(f"renaming tag and title columns to genre and song respectively from chunk {idx}...")
+    chunk = chunk.rename({"tag":"genre", "title":"song"}, axis=1)
+
+    # Dropping the songs with genre = 'misc'
+    logger.info(f"dropping the songs with genre = 'misc' from chuck {idx}...")
+    with profiler.stage("misc_genre", idx, len(chunk)) as stage:
+        chunk = chunk[chunk['genre'] != 'misc']
+        stage["rows_out"] = len(chunk)
+    
+    if language_detector is not None:
+        # analyze language
+        logger.info(f"analyzing language from chunk {idx}...")
+        with profiler.stage("language", idx, len(chunk)) as stage:
+            chunk["language"] = language_detector.detect(chunk["lyrics"], shard_name=f"chunk-{idx:05d}")
+            stage["rows_out"] = len(chunk)
+        logger.info(f'{len(chunk[chunk["language"].isna()])} not identified lyrics using by the language detection model.')
+        
+        # drop non-english lyrics
+        logger.info(f"dropping non-english lyrics from chunk {idx}...")
+        with profiler.stage("non_english", idx, len(chunk)) as stage:
+            chunk = chunk[chunk["language"] == "en"].drop(columns="language")
+            stage["rows_out"] = len(chunk)
+
+    signatures = None
+    if minhasher is not None:
+        # hash lyrics for near-duplicate detection
+        logger.info(f"computing minhash signatures of lyrics in chunk {idx}...")
+        with profiler.stage("minhash", idx, len(chunk)) as stage:
+            signatures = minhasher.signatures(chunk["lyrics"])
+            stage["rows_out"] = len(chunk)
+
+    return chunk, signatures, profiler.records
+
+
+def _iter_pushdown_chunks(input_filepath):
+    """ 
+        Reads the raw data in the same chunks as pd.read_csv, but evaluates the metadata filters of process_chunk
+        (N.A. lyrics, romanizations, years, duplicates and genre) on Arrow columns first,
+        so lyrics are only converted to Python strings for the rows that pass them.
+        The filters keep their order, so the rows passed on to process_chunk are exactly the ones it would keep.
+    """
+    for table in iter_csv_tables(input_filepath, RAW_COLUMNS, CHUNK_SIZE):
+        keep = pc.is_valid(table["lyrics"])
+        keep = pc.and_(keep, pc.fill_null(pc.not_equal(table["artist"], "Genius Romanizations"), True))
+        romanized = pc.match_substring_regex(table["title"], r"\(?romanized\)?", ignore_case=True)
+        keep = pc.and_(keep, pc.invert(pc.fill_null(romanized, False)))
+        keep = pc.and_(keep, pc.fill_null(pc.and_(pc.greater(table["year"], 1980), pc.less(table["year"], 2023)), False))
+        table = table.filter(keep)
+
+        # duplicates are found on the short metadata columns only
+        first = ~table.select(["title", "artist", "year"]).to_pandas().duplicated().to_numpy()
+        keep = pc.and_(pa.array(first), pc.fill_null(pc.not_equal(table["tag"], "misc"), True))
+        yield to_compact_pandas(table.filter(keep))
+
+
+def _iter_processed_chunks(chunks, n_workers, max_in_flight, start_chunk=0, **chunk_kwargs):
+    """ 
+        Yields (idx, process_chunk result) pairs in input order, skipping the chunks
+        before start_chunk (already processed by an interrupted run). With more than one worker
+        the chunks are processed in a pool of processes, with at most max_in_flight
+        chunks submitted at any time so memory stays flat however many workers are used.
+        chunk_kwargs are passed on to process_chunk.
+    """
+    if n_workers == 1:
+        for idx, chunk in enumerate(chunks):
+            if idx < start_chunk:
+                continue
+            yield idx, process_chunk(chunk, idx, **chunk_kwargs)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        try:
+            for idx, chunk in enumerate(chunks):
+                if idx < start_chunk:
+                    continue
+                pending.append((idx, executor.submit(process_chunk, chunk, idx, **chunk_kwargs)))
+                del chunk
+                
+                # only the writer drains the queue, so results come back in input order
+                if len(pending) >= max_in_flight:
+                    done_idx, future = pending.popleft()
+                    yield done_idx, future.result()
+
+            while pending:
+                done_idx, future = pending.popleft()
+                yield done_idx, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
 
 
-def makeProcessed():
+def _rebuild_indexes(processed_filepath, dedup_index, minhasher=None, lsh_index=None):
+    """ 
+        Adds the rows already saved in the processed data set to the deduplication indexes,
+        which are the rows the run that saved them indexed.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info(f'rebuilding deduplication indexes from {processed_filepath}')
+    
+    columns = DEDUP_KEY + (["lyrics"] if lsh_index is not None else [])
+    for chunk in iter_dataset(processed_filepath, columns=columns, chunksize=CHUNK_SIZE):
+        dedup_index.add(key_hashes(chunk, DEDUP_KEY))
+        if lsh_index is not None:
+            lsh_index.add(minhasher.signatures(chunk["lyrics"]))
+
+
+def makeProcessed(n_workers=1, max_in_flight=None, output_format="csv", dedup_index_path=None,
+                  near_dedup_threshold=None, detect_language=False, reader="pandas"):
     """ 
         Preprocesses the raw data from /projectdir/data/raw
         and saves the preprocessed data in /projectdir/data/processed.
+
+        n_workers chunks are processed in parallel (1 processes them in this process)
+        and max_in_flight bounds the number of chunks held in memory at once
+        (defaults to twice the number of workers).
+        output_format is either "csv" or "parquet" (a genre partitioned directory written chunk by chunk).
+        Entries duplicated across chunks are dropped using a hash index of their (song, artist, year) key,
+        which is loaded from and saved to dedup_index_path when given so that incremental runs skip
+        entries processed by earlier runs.
+        With a near_dedup_threshold, lyrics whose estimated Jaccard similarity to earlier lyrics reaches it
+        (remixes, live versions, re-uploads) are dropped too, using MinHash signatures computed by the workers
+        and an LSH index kept by the writer, which compares the signatures of the lyrics sharing a band.
+        With detect_language, only english lyrics are kept: a cheap heuristic settles the plain cases and
+        the rest go through the xlm-roberta classifier in batches, with results cached on disk
+        (keyed by the hash of the lyrics) so re-runs skip lyrics already classified.
+        reader="arrow" streams the raw data with pyarrow and applies the metadata filters before converting
+        the lyrics to Python strings, which skips most of the lyric text, instead of parsing every chunk with pandas.
+        Every saved chunk is recorded in a journal next to the processed data set, so an interrupted run
+        resumes after the last saved chunk (rebuilding the indexes from the rows already saved)
+        instead of starting over.
+        Wall time, rows in and out and memory of every step of every chunk are saved in /projectdir/reports/profiling.
     """
     logger = logging.getLogger(__name__)
     logger.info('making preprocessed data set from raw data')
     
     input_filepath = Path(os.path.join(PROJECT_DIR, "data", "raw", "song_lyrics.csv"))
-    processed_filepath = Path(os.path.join(PROJECT_DIR, "data", "processed", "lyrics_processed.csv"))
+    processed_filepath = dataset_filepath("processed", "lyrics_processed", output_format)
     
     if not os.path.exists(input_filepath):
         logger.error(f'input_filepath: {input_filepath} does not exist! Please run make_raw.py first to download the raw data.')
@@ -33,7 +219,25 @@ def makeProcessed():
     
     logger.info('input_filepath: {}'.format(input_filepath))
     
-    if os.path.exists(processed_filepath):
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers < 1:
+        raise ValueError("n_workers must be at least 1")
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    if max_in_flight < n_workers:
+        raise ValueError("max_in_flight must be at least n_workers to keep every worker busy")
+    if reader not in READERS:
+        raise ValueError(f"Unknown reader {reader}, expected one of {READERS}")
+    
+    profiler = StageProfiler("make_processed")
+    journal = ChunkJournal(processed_filepath, config={
+        "chunk_size": CHUNK_SIZE,
+        "near_dedup_threshold": near_dedup_threshold,
+        "detect_language": detect_language,
+    })
+    resuming = journal.exists() and not journal.complete and (os.path.exists(processed_filepath) or not journal.records)
+    if os.path.exists(processed_filepath) and not resuming:
         logger.warning(f'processed_filepath: {processed_filepath} already exists! Please delete it to re-run the preprocessing.')
         return
     
@@ -44,68 +248,71 @@ def makeProcessed():
     
     logger.info('----------------------------------------------------')
     
-    with pd.read_csv(
-        input_filepath,
-        chunksize=5 * (10**3),
-        usecols=["title", "artist", "year", "tag", "lyrics"],
-        dtype={"year": np.int16}
-    ) as chunks:
-
-        for idx, chunk in enumerate(chunks):
-            logger.info(f"Processing chunk {idx}...")
+    if dedup_index_path is not None and os.path.exists(dedup_index_path):
+        logger.info(f'loading deduplication index from {dedup_index_path}')
+        dedup_index = HashIndex.load(dedup_index_path)
+    else:
+        dedup_index = HashIndex()
+    
+    minhasher, lsh_index = None, None
+    if near_dedup_threshold is not None:
+        minhasher = MinHasher(threshold=near_dedup_threshold)
+        lsh_index = LSHIndex(minhasher.bands, minhasher.rows, near_dedup_threshold)
+        logger.info(f'near-duplicate detection with {minhasher.bands} bands of {minhasher.rows} rows')
+    
+    language_detector = LanguageDetector() if detect_language else None
+    
+    if resuming:
+        logger.info(f'resuming preprocessing from chunk {journal.next_chunk} using {journal.filepath}')
+        journal.resume()
+        if journal.records:
+            _rebuild_indexes(processed_filepath, dedup_index, minhasher, lsh_index)
+    else:
+        journal.start()
+    
+    if reader == "arrow":
+        raw_chunks = closing(_iter_pushdown_chunks(input_filepath))
+    else:
+        raw_chunks = pd.read_csv(
+            input_filepath,
+            chunksize=CHUNK_SIZE,
+            usecols=RAW_COLUMNS,
+            dtype=csv_dtypes(RAW_COLUMNS)
+        )
+    
+    with raw_chunks as chunks:
 
-            # drop N.A. lyrics
-            logger.info(f"dropping N.A. lyrics from chunk {idx}...")
-            chunk = chunk.dropna(subset=["lyrics"])
+        chunks = profiler.iterate("read", chunks)
+        for idx, (chunk, signatures, stage_records) in _iter_processed_chunks(
+                chunks, n_workers, max_in_flight, journal.next_chunk,
+                minhasher=minhasher, language_detector=language_detector):
+            profiler.extend(stage_records)
             
-            # drop romanizations
-            logger.info(f"dropping romanizations from chunk {idx}...")
-            chunk = chunk[chunk["artist"] != "Genius Romanizations"]
-            chunk = chunk[~chunk["title"].str.contains(r"\(?romanized\)?", regex=True, na=False, case=False)]
-
-            # remove invalid years
-            logger.info(f"removing invalid years from chunk {idx}...")
-            chunk = chunk[chunk['year'] > 1980]
-            chunk = chunk[chunk["year"] < 2023]
+            # remove entries already seen in earlier chunks
+            logger.info(f"removing entries duplicated across chunks from chunk {idx}...")
+            with profiler.stage("global_duplicates", idx, len(chunk)) as stage:
+                hashes = key_hashes(chunk, DEDUP_KEY)
+                keep = dedup_index.first_unseen(hashes)
+                chunk, hashes = chunk[keep], hashes[keep]
+                stage["rows_out"] = len(chunk)
             
-            # remove duplicated entries
-            logger.info(f"removing duplicated entries from chunk {idx}...")
-            chunk = chunk.drop_duplicates(subset=["title", "artist", "year"])
+            # remove lyrics nearly identical to earlier ones
+            if lsh_index is not None:
+                logger.info(f"removing near-duplicate lyrics from chunk {idx}...")
+                with profiler.stage("near_duplicates", idx, len(chunk)) as stage:
+                    near_keep = lsh_index.keep_first_seen(signatures[keep])
+                    chunk, hashes = chunk[near_keep], hashes[near_keep]
+                    stage["rows_out"] = len(chunk)
             
-            # remove special characters from lyrics
-            logger.info(f"removing special characters from lyrics in chunk {idx}...")
-            pattern = r"(?m)^\[.*?\]$"
-            chunk["lyrics"] = chunk["lyrics"].str.replace(pattern, "", regex=True)
-            
-            # remove empty lines
-            logger.info(f"removing empty lines from lyrics in chunk {idx}...")
-            pattern = r"\n|\n\n"
-            chunk["lyrics"] = chunk["lyrics"].str.replace(pattern, " ", regex=True)
-
-            # drop lyrics that are too short or too long
-            logger.info(f"dropping lyrics that are too short or too long from chunk {idx}...")
-            chunk = chunk[chunk["lyrics"].str.len().between(10**2, 10**4)]
-
-            # Dropping the views column and renaming the tag and title columns
-            logger.info(f"renaming tag and title columns to genre and song respectively from chunk {idx}...")
-            chunk = chunk.rename({"tag":"genre", "title":"song"}, axis=1)
-
-            # Dropping the songs with genre = 'misc'
-            logger.info(f"dropping the songs with genre = 'misc' from chuck {idx}...")
-            chunk = chunk[chunk['genre'] != 'misc']
-            
-            # # analyze language
-            # logger.info(f"analyzing language from chunk {idx}...")
-            # chunk["language"] = chunk["lyrics"].apply(identify_language)
-            # logger.info(f'{len(chunk[chunk["language"].isna()])} not identified lyrics using by the language detection model.')
-            
-            # # drop non-english lyrics
-            # logger.info(f"dropping non-english lyrics from chunk {idx}...") 
-            # chunk = chunk[chunk["language"] == "en"][["artist", "tag", "lyrics"]]
+            # only the saved rows are indexed, as a resumed run rebuilds the indexes from them
+            dedup_index.add(hashes)
             
             # save processed data
             logger.info(f"saving processed data from chunk {idx}...")
-            chunk.to_csv(processed_filepath, mode="a", header=not os.path.exists(processed_filepath), index=False)
+            with profiler.stage("write", idx, len(chunk)) as stage:
+                offset = write_chunk(chunk, processed_filepath, idx, partition_col=PROCESSED_PARTITION, schema=PROCESSED_SCHEMA)
+                journal.record(idx, offset)
+                stage["rows_out"] = len(chunk)
             
             logger.info(f"garbage collecting chunk {idx}...")
             del chunk
@@ -113,6 +320,21 @@ def makeProcessed():
             
             logger.info(f"finished processing chunk {idx}...")
             logger.info("----------------------------------------------------")
+    
+    journal.finish()
+    if language_detector is not None:
+        logger.info(f'compacting language cache in {language_detector.cache_dirpath}')
+        LanguageCache(language_detector.cache_dirpath).compact()
+    
+    logger.info(f'saved profiling of every step in {profiler.save()}')
+    logger.info('\n' + profiler.summary().to_string(index=False))
+    
+    logger.info(f'deduplication index holds {len(dedup_index)} entries ({dedup_index.nbytes / 2**20:.1f} MiB)')
+    if dedup_index_path is not None:
+        logger.info(f'saving deduplication index to {dedup_index_path}')
+        dedup_index.save(dedup_index_path)
+    if lsh_index is not None:
+        logger.info(f'near-duplicate index holds {len(lsh_index)} lyrics ({lsh_index.nbytes / 2**20:.1f} MiB)')
             
     logger.info('finished preprocessing from raw data and saved in {processed_filepath}')
     
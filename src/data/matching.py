@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+
+class AhoCorasick:
+    """
+        Aho-Corasick automaton over a list of patterns: search() finds every pattern occurring
+        in a text (overlapping ones included) in a single pass over it, however many patterns there are.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for idx, pattern in enumerate(self.patterns):
+            node = 0
+            for char in pattern:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][char] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = child
+            self._out[node].append(idx)
+
+        # breadth first, so the failure link of a node (its longest proper suffix in the trie)
+        # is set before its children's, which also inherit the patterns ending at it
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def search(self, text):
+        """
+            Returns the set of indices of the patterns occurring in text.
+        """
+        # an empty pattern occurs in every text
+        found = set(self._out[0])
+        node = 0
+        for char in text:
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            if self._out[node]:
+                found.update(self._out[node])
+        return found
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+
+FORMATS = ("csv", "parquet")
+ROW_GROUP_SIZE = 10**4
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+# values read as missing, the same as pandas.read_csv
+CSV_NULL_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                   "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+# compact pandas dtypes of the columns of every stage: labels as categories,
+# text as Arrow backed strings instead of Python objects
+TEXT_DTYPE = pd.StringDtype("pyarrow")
+COMPACT_DTYPES = {
+    "tag": "category",
+    "genre": "category",
+    "artist": "category",
+    "year": np.int16,
+    "title": TEXT_DTYPE,
+    "song": TEXT_DTYPE,
+    "lyrics": TEXT_DTYPE,
+    "cleaned_lyrics": TEXT_DTYPE,
+    "final_lyrics": TEXT_DTYPE,
+}
+# integer columns downcast to the smallest type holding their values
+COMPACT_INTEGERS = ["views"]
+# bytes of csv the pyarrow reader parses at a time. The parse buffers of blocks of 16MiB
+# took more memory than the compact dtypes saved, 1MiB blocks parse as fast
+CSV_BLOCK_SIZE = 2**20
+# Arrow types csv columns are parsed as, other columns are inferred.
+# views may be missing, so they are parsed as floats and downcast to integers when they are whole
+CSV_COLUMN_TYPES = {col: pa.string() for col, dtype in COMPACT_DTYPES.items() if dtype != np.int16}
+CSV_COLUMN_TYPES.update({"year": pa.int16(), "views": pa.float64()})
+
+# typed columns of the parquet data sets, the partition column is kept in the directory names
+PROCESSED_PARTITION = "genre"
+PROCESSED_SCHEMA = pa.schema([
+    ("song", pa.string()),
+    ("artist", pa.string()),
+    ("year", pa.int16()),
+    ("lyrics", pa.string()),
+])
+
+FEATURES_PARTITION = "tag"
+FEATURES_SCHEMA = pa.schema([
+    ("title", pa.string()),
+    ("artist", pa.string()),
+    ("year", pa.int16()),
+    ("views", pa.int64()),
+    ("lyrics", pa.string()),
+    ("cleaned_lyrics", pa.string()),
+    ("final_lyrics", pa.string()),
+])
+
+
+def dataset_filepath(stage, name, fmt="csv"):
+    """
+        Returns the path of the data set `name` in /projectdir/data/<stage> stored as `fmt`.
+        Parquet data sets are directories of partitioned part files.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, expected one of {FORMATS}")
+    return Path(os.path.join(PROJECT_DIR, "data", stage, f"{name}.{fmt}"))
+
+
+def is_parquet(filepath):
+    return Path(filepath).suffix == ".parquet"
+
+
+def remove_dataset(filepath):
+    """
+        Deletes a data set, whether it is a single csv file or a parquet directory.
+    """
+    if os.path.isdir(filepath):
+        shutil.rmtree(filepath)
+    elif os.path.exists(filepath):
+        os.remove(filepath)
+
+
+def compact_dtypes(df):
+    """
+        Converts the columns of df to the compact dtypes shared by every stage.
+    """
+    df = df.astype({col: dtype for col, dtype in COMPACT_DTYPES.items() if col in df.columns})
+    for col in COMPACT_INTEGERS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    return df
+
+
+def to_compact_pandas(table):
+    """
+        Converts a pyarrow Table to a DataFrame with the compact dtypes, dictionary encoding the
+        category columns and keeping text in Arrow buffers, so it never goes through Python objects.
+    """
+    for col in table.column_names:
+        if COMPACT_DTYPES.get(col) == "category" and not pa.types.is_dictionary(table.schema.field(col).type):
+            table = table.set_column(table.schema.get_field_index(col), col, pc.dictionary_encode(table[col]))
+    df = table.to_pandas(types_mapper={pa.string(): TEXT_DTYPE, pa.large_string(): TEXT_DTYPE}.get)
+    return compact_dtypes(df)
+
+
+def csv_dtypes(columns=None):
+    """
+        The compact dtypes of `columns` (all known columns if None) for pd.read_csv(dtype=...),
+        so the text is never loaded as Python objects.
+    """
+    return {col: dtype for col, dtype in COMPACT_DTYPES.items() if columns is None or col in columns}
+
+
+def write_chunk(df, filepath, idx, partition_col=None, schema=None):
+    """
+        Appends chunk `idx` to the data set at filepath and returns the output offset after it:
+        the csv file size, or the part files written for the chunk.
+        CSV data sets are appended to in place, parquet data sets get one typed
+        part file per chunk in each `partition_col=<value>` directory.
+    """
+    if not is_parquet(filepath):
+        header = not os.path.exists(filepath)
+        with open(filepath, "a", newline="", encoding="utf-8") as f:
+            df.to_csv(f, header=header, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        return os.path.getsize(filepath)
+
+    if partition_col is None:
+        parts = [(None, df)]
+    else:
+        parts = df.groupby(partition_col, sort=False, dropna=False, observed=True)
+
+    part_files = []
+    for value, part in parts:
+        part_dir = Path(filepath)
+        if partition_col is not None:
+            value = NULL_PARTITION if pd.isna(value) else value
+            part_dir = part_dir / f"{partition_col}={value}"
+            part = part.drop(columns=partition_col)
+        os.makedirs(part_dir, exist_ok=True)
+
+        table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+        part_file = part_dir / f"part-{idx:05d}.parquet"
+        pq.write_table(table, part_file, row_group_size=ROW_GROUP_SIZE)
+        part_files.append(str(part_file.relative_to(filepath)))
+    return part_files
+
+
+def truncate_dataset(filepath, chunk, offset):
+    """
+        Drops everything written after `chunk`, whose output offset (as returned by write_chunk) is given,
+        i.e. the partial tail left by an interrupted run. Without a chunk the whole data set is removed.
+    """
+    if chunk is None:
+        remove_dataset(filepath)
+    elif is_parquet(filepath):
+        for part_file in Path(filepath).glob("**/part-*.parquet"):
+            if int(part_file.stem.split("-")[1]) > chunk:
+                os.remove(part_file)
+    else:
+        with open(filepath, "r+b") as f:
+            f.truncate(offset)
+
+
+def dataset_columns(filepath):
+    """
+        Returns the column names of a data set without loading any rows.
+    """
+    if is_parquet(filepath):
+        return ds.dataset(filepath, format="parquet", partitioning="hive").schema.names
+    return list(pd.read_csv(filepath, nrows=0).columns)
+
+
+def filters_expression(filters, ignore_case=()):
+    """
+        The pyarrow expression of `filters`, a list of (column, op, value) tuples that must all hold.
+        The string columns in ignore_case are compared lower-cased to the lower-cased values
+        (as df[column].str.lower() == value.lower() does), with the ==, !=, in and not in ops.
+    """
+    if not filters:
+        return None
+    expression = None
+    for col, op, value in filters:
+        if col not in ignore_case:
+            term = pq.filters_to_expression([(col, op, value)])
+        else:
+            field = pc.utf8_lower(pc.field(col))
+            if op in ("in", "not in"):
+                term = field.isin([str(v).lower() for v in value])
+                term = ~term if op == "not in" else term
+            elif op in ("=", "=="):
+                term = field == str(value).lower()
+            elif op == "!=":
+                term = field != str(value).lower()
+            else:
+                raise ValueError(f"Can't compare {col} ignoring case with {op}")
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def read_dataset(filepath, columns=None, filters=None, ignore_case=()):
+    """
+        Loads a data set, keeping only `columns` and the rows matching `filters`,
+        a list of (column, op, value) tuples that must all hold, with compact dtypes.
+        The columns in ignore_case are matched ignoring case (see filters_expression).
+        For parquet data sets only the needed columns, partitions and row groups are read.
+    """
+    expression = filters_expression(filters, ignore_case)
+    if is_parquet(filepath):
+        dataset = ds.dataset(filepath, format="parquet", partitioning="hive")
+        return to_compact_pandas(dataset.to_table(columns=columns, filter=expression))
+
+    usecols = columns
+    if columns is not None and filters:
+        usecols = list(dict.fromkeys(list(columns) + [col for col, _, _ in filters]))
+    table = pacsv.read_csv(filepath, read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                           parse_options=_csv_parse_options(),
+                           convert_options=_csv_convert_options(filepath, usecols))
+    if expression is not None:
+        table = table.filter(expression)
+    if columns is not None:
+        table = table.select(list(columns))
+    return to_compact_pandas(table)
+
+
+def iter_dataset(filepath, columns=None, chunksize=10**5, filters=None, ignore_case=()):
+    """
+        Streams a data set as DataFrames of at most chunksize rows with compact dtypes, reading only `columns`
+        and keeping only the rows matching `filters` (as in read_dataset).
+    """
+    expression = filters_expression(filters, ignore_case)
+    if is_parquet(filepath):
+        dataset = ds.dataset(filepath, format="parquet", partitioning="hive")
+        for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=chunksize):
+            yield to_compact_pandas(pa.Table.from_batches([batch]))
+    else:
+        usecols = columns
+        if columns is not None and filters:
+            usecols = list(dict.fromkeys(list(columns) + [col for col, _, _ in filters]))
+        for table in iter_csv_tables(filepath, usecols, chunksize):
+            if expression is not None:
+                table = table.filter(expression)
+            if columns is not None:
+                table = table.select(list(columns))
+            yield to_compact_pandas(table)
+
+
+def iter_csv_tables(filepath, columns, chunk_size, block_size=CSV_BLOCK_SIZE):
+    """
+        Streams `columns` (all of them if None, in file order) of a csv file as pyarrow Tables of exactly
+        chunk_size rows (the last one may be shorter), so chunk boundaries match pandas.read_csv(chunksize=chunk_size).
+        Values stay in Arrow buffers until converted, so rows filtered out before to_pandas()
+        never become Python objects.
+    """
+    reader = pacsv.open_csv(
+        filepath,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        parse_options=_csv_parse_options(),
+        convert_options=_csv_convert_options(filepath, columns),
+    )
+    pending, pending_rows = [], 0
+    for batch in reader:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunk_size:
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, chunk_size)
+            rest = table.slice(chunk_size)
+            pending, pending_rows = rest.to_batches(), rest.num_rows
+    if pending_rows:
+        yield pa.Table.from_batches(pending)
+
+
+class ChunkJournal:
+    """
+        Journal of the chunks appended to a data set, kept next to it as <data set>.journal.
+        Every completed chunk is recorded (as a json line, synced to disk) with the output offset after it,
+        so an interrupted run can truncate the partial tail and resume after the last completed chunk.
+    """
+
+    def __init__(self, filepath, config=None):
+        self.dataset_filepath = Path(filepath)
+        self.filepath = Path(f"{filepath}.journal")
+        self.config = config
+        self.stored_config = None
+        self.records = []
+        self.complete = False
+        if os.path.exists(self.filepath):
+            self._load()
+
+    def _load(self):
+        with open(self.filepath, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line torn by a crash, nothing after it was completed
+                    break
+                if "config" in record:
+                    self.stored_config = record["config"]
+                elif record.get("complete"):
+                    self.complete = True
+                else:
+                    self.records.append(record)
+
+    def exists(self):
+        return os.path.exists(self.filepath)
+
+    @property
+    def next_chunk(self):
+        return self.records[-1]["chunk"] + 1 if self.records else 0
+
+    def start(self):
+        """
+            Starts a new journal, forgetting any previous run.
+        """
+        self.records = []
+        self.complete = False
+        self._write([{"config": self.config}], mode="w")
+
+    def resume(self):
+        """
+            Truncates the data set to the last completed chunk and rewrites the journal without any torn line.
+        """
+        if self.stored_config != self.config:
+            raise ValueError(f"{self.filepath} was written with {self.stored_config}, not {self.config}. "
+                             "Please delete it and the data set to re-run the preprocessing.")
+        last = self.records[-1] if self.records else {"chunk": None, "offset": None}
+        truncate_dataset(self.dataset_filepath, last["chunk"], last["offset"])
+        self._write([{"config": self.config}] + self.records, mode="w")
+
+    def record(self, idx, offset):
+        self.records.append({"chunk": idx, "offset": offset})
+        self._write(self.records[-1:])
+
+    def finish(self):
+        self.complete = True
+        self._write([{"complete": True}])
+
+    def _write(self, records, mode="a"):
+        with open(self.filepath, mode, encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _csv_parse_options():
+    return pacsv.ParseOptions(newlines_in_values=True)
+
+
+def _csv_convert_options(filepath, columns=None):
+    # like pd.read_csv(usecols=...), columns keep the order of the file
+    header = dataset_columns(filepath)
+    columns = [col for col in header if columns is None or col in columns]
+    return pacsv.ConvertOptions(
+        include_columns=columns,
+        column_types={col: CSV_COLUMN_TYPES[col] for col in columns if col in CSV_COLUMN_TYPES},
+        null_values=CSV_NULL_VALUES,
+        strings_can_be_null=True,
+    )
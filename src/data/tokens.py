@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import glob
+import hashlib
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+TOKENS_DIR = Path(os.path.join(PROJECT_DIR, "data", "features", "lyrics_tokens"))
+TOKEN_CACHE_DIR = Path(os.path.join(PROJECT_DIR, "data", "features", "token_cache"))
+TOKENIZER_CKPT = "gpt2"
+SPECIAL_TOKENS = ['[s:genre]', '[e:genre]', '[s:lyrics]', '[e:lyrics]']
+
+TOKEN_DTYPE = np.uint16
+SHARD_TOKENS = 2**24
+META_FILE = "meta.json"
+INDEX_FILE = "index.npy"
+
+
+def load_tokenizer(tokenizer_ckpt=TOKENIZER_CKPT, special_tokens=SPECIAL_TOKENS):
+    """
+        The GPT-2 tokenizer with the project's special tokens, padding with the end of text token.
+    """
+    from transformers import GPT2TokenizerFast
+    tokenizer = GPT2TokenizerFast.from_pretrained(tokenizer_ckpt)
+    tokenizer.add_special_tokens({'additional_special_tokens': list(special_tokens)})
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def file_hash(filepath, block_size=2**20):
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def tokenizer_hash(tokenizer):
+    """
+        Hash of the vocabulary (added tokens included) and special tokens of a tokenizer.
+    """
+    sha = hashlib.sha256(type(tokenizer).__name__.encode())
+    sha.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    sha.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def prompts_hash(texts):
+    """
+        Hash of a sequence of texts, in order.
+    """
+    sha = hashlib.sha256()
+    for text in texts:
+        sha.update(text.encode())
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def tokenization_key(filepath, tokenizer, block_size):
+    """
+        Cache key of the tokenization of a file: changes with its contents, the tokenizer or block_size.
+    """
+    sha = hashlib.sha256(f"{file_hash(filepath)}-{tokenizer_hash(tokenizer)}-{block_size}".encode())
+    return sha.hexdigest()[:32]
+
+
+# the tokenizer of each worker process, set once by _init_worker instead of being sent with every batch
+_WORKER_TOKENIZER = None
+
+
+def _init_worker(tokenizer):
+    global _WORKER_TOKENIZER
+    # the worker processes already run in parallel
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _WORKER_TOKENIZER = tokenizer
+
+
+def _tokenize_batch(texts, max_length):
+    return _WORKER_TOKENIZER(texts, truncation=max_length is not None, max_length=max_length)["input_ids"]
+
+
+def tokenize_texts(tokenizer, texts, max_length=None, batch_size=1000, n_workers=1):
+    """
+        Yields the token ids of texts (truncated to max_length tokens if given), in order,
+        tokenizing them in batches through the fast tokenizer and, with several n_workers,
+        in as many worker processes.
+    """
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    if n_workers == 1 or len(batches) < 2:
+        for batch in batches:
+            yield from tokenizer(batch, truncation=max_length is not None, max_length=max_length)["input_ids"]
+        return
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(tokenizer,)) as executor:
+        for ids in executor.map(_tokenize_batch, batches, [max_length] * len(batches)):
+            yield from ids
+
+
+def shards_exist(dirpath):
+    """
+        Whether complete token shards were written in dirpath.
+    """
+    return os.path.exists(Path(dirpath) / META_FILE)
+
+
+class TokenShardWriter:
+    """
+        Tokenizes documents in batches and appends their token ids to flat uint16 shard files
+        of about shard_tokens tokens each, in /dirpath/shard-<n>.bin.
+        close() writes the index, one (shard, offset, length) row per document in the order they were added,
+        and meta.json with the tokenizer settings the shards are only valid for and the prompts_hash
+        of the documents (None when some were added already tokenized), which tells what they were tokenized from.
+        An already loaded tokenizer can be given instead of being loaded from tokenizer_ckpt.
+    """
+
+    def __init__(self, dirpath=TOKENS_DIR, tokenizer_ckpt=TOKENIZER_CKPT, special_tokens=SPECIAL_TOKENS,
+                 batch_size=1000, shard_tokens=SHARD_TOKENS, tokenizer=None):
+        self.dirpath = Path(dirpath)
+        self.tokenizer_ckpt = tokenizer_ckpt
+        self.special_tokens = list(special_tokens)
+        self.tokenizer = tokenizer if tokenizer is not None else load_tokenizer(tokenizer_ckpt, special_tokens)
+        if len(self.tokenizer) > np.iinfo(TOKEN_DTYPE).max + 1:
+            raise ValueError(f"A vocabulary of {len(self.tokenizer)} tokens doesn't fit in {np.dtype(TOKEN_DTYPE)}")
+        self.batch_size = batch_size
+        self.shard_tokens = shard_tokens
+
+        # start from an empty directory, stale shards would be indexed by nothing
+        os.makedirs(self.dirpath, exist_ok=True)
+        for filepath in glob.glob(os.path.join(self.dirpath, "shard-*.bin")) + [self.dirpath / INDEX_FILE,
+                                                                              self.dirpath / META_FILE]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        self.index = []
+        self.shards = []
+        self._texts_sha = hashlib.sha256()
+        self._file = None
+        self._offset = 0
+
+    def _open_shard(self):
+        if self._file is not None:
+            self._file.close()
+        self.shards.append(f"shard-{len(self.shards):05d}.bin")
+        self._file = open(self.dirpath / self.shards[-1], "wb")
+        self._offset = 0
+
+    def add(self, texts):
+        """
+            Tokenizes and appends the documents in texts.
+        """
+        texts = list(texts)
+        if self._texts_sha is not None:
+            for text in texts:
+                self._texts_sha.update(text.encode())
+                self._texts_sha.update(b"\0")
+        self._append(tokenize_texts(self.tokenizer, texts, batch_size=self.batch_size))
+
+    def add_ids(self, documents):
+        """
+            Appends documents already tokenized, as sequences of token ids.
+        """
+        self._texts_sha = None
+        self._append(documents)
+
+    def _append(self, documents):
+        for ids in documents:
+            if self._file is None or (self._offset and self._offset + len(ids) > self.shard_tokens):
+                self._open_shard()
+            self._file.write(np.asarray(ids, dtype=TOKEN_DTYPE).tobytes())
+            self.index.append((len(self.shards) - 1, self._offset, len(ids)))
+            self._offset += len(ids)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = np.array(self.index, dtype=np.int64).reshape(-1, 3)
+        np.save(self.dirpath / INDEX_FILE, index)
+        meta = {
+            "tokenizer": self.tokenizer_ckpt,
+            "special_tokens": self.special_tokens,
+            "vocab_size": len(self.tokenizer),
+            "dtype": np.dtype(TOKEN_DTYPE).name,
+            "shards": self.shards,
+            "documents": len(index),
+            "tokens": int(index[:, 2].sum()),
+            "prompts_hash": self._texts_sha.hexdigest() if self._texts_sha is not None else None,
+        }
+        # written last, so a directory without it was never completed
+        with open(self.dirpath / META_FILE, "w") as f:
+            json.dump(meta, f, indent=4)
+        return meta
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            # leave the shards without meta.json, so they are not read as complete
+            self._file.close()
+            self._file = None
+
+
+class TokenShards:
+    """
+        Read-only view of the shards written by TokenShardWriter: shards[i] is the token ids of document i,
+        read from the memory mapped shard files without loading them.
+        Raises ValueError when they were written with another tokenizer or special tokens than expected
+        (not checked when tokenizer_ckpt is None).
+    """
+
+    def __init__(self, dirpath=TOKENS_DIR, tokenizer_ckpt=TOKENIZER_CKPT, special_tokens=SPECIAL_TOKENS):
+        self.dirpath = Path(dirpath)
+        meta_filepath = self.dirpath / META_FILE
+        if not shards_exist(self.dirpath):
+            raise ValueError(f"No complete token shards in {self.dirpath}, please export them first.")
+        with open(meta_filepath) as f:
+            self.meta = json.load(f)
+        expected = {"tokenizer": tokenizer_ckpt, "special_tokens": list(special_tokens)}
+        written = {key: self.meta[key] for key in expected}
+        if tokenizer_ckpt is not None and written != expected:
+            raise ValueError(f"{self.dirpath} was tokenized with {written}, not {expected}. "
+                             "Please export the token shards again.")
+        self.index = np.load(self.dirpath / INDEX_FILE)
+        self.shards = [_memmap(self.dirpath / shard, self.meta["dtype"]) for shard in self.meta["shards"]]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        shard, offset, length = self.index[i]
+        return self.shards[shard][offset:offset + length]
+
+    @property
+    def lengths(self):
+        return self.index[:, 2]
+
+
+def _memmap(filepath, dtype):
+    # empty files can't be memory mapped
+    if os.path.getsize(filepath) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filepath, dtype=dtype, mode="r")
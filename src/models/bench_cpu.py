@@ -0,0 +1,61 @@
+import logging
+import torch
+import pandas as pd
+from bench_training import load_shards, small_model, run_batches, CountingCollator, PAD_TOKEN_ID
+from train_model import (MemmapLyricsDataset, DynamicPaddingCollator, LengthBucketSampler,
+                         host_cpus, cpu_bf16_supported)
+
+
+def benchCPU(steps=10, warmup=3, batch_size=8, block_size=128, n=2000):
+    """
+        Compares the training steps/sec of a small GPT-2 on CPU for every combination of intra-op threads
+        (1, half and all of the host's CPUs), bf16 autocast (when the CPU supports it natively) and torch.compile,
+        with the dynamically padded, length bucketed batches of training.
+        The first `warmup` steps (where torch.compile compiles) are timed apart from the `steps` after them.
+    """
+    logger = logging.getLogger(__name__)
+    shards = load_shards(n)
+    cpus = host_cpus()
+    bf16_supported = cpu_bf16_supported()
+    logger.info(f'benchmarking CPU training on {cpus} CPUs (native bf16: {bf16_supported}), '
+                f'{warmup} + {steps} batches of {batch_size} examples')
+
+    dataset = MemmapLyricsDataset(shards, block_size, PAD_TOKEN_ID, pad_to_block=False)
+    default_threads = torch.get_num_threads()
+    results = []
+    for threads in sorted({1, max(1, cpus // 2), cpus}):
+        for bf16 in (False, True) if bf16_supported else (False,):
+            for compile in (False, True):
+                torch.set_num_threads(threads)
+                torch._dynamo.reset()
+                model = small_model(block_size)
+                if compile:
+                    model = torch.compile(model)
+                loader = torch.utils.data.DataLoader(
+                    dataset, batch_size=batch_size, sampler=LengthBucketSampler(dataset.lengths, batch_size),
+                    collate_fn=CountingCollator(DynamicPaddingCollator(PAD_TOKEN_ID, pad_to_multiple_of=32)))
+
+                # timed on the batches after the warmup ones, whose shapes may not have been compiled yet
+                batches = iter(loader)
+                warmup_seconds, _, _ = run_batches(model, batches, warmup, bf16)
+                seconds, real_tokens, _ = run_batches(model, batches, steps, bf16)
+                results.append({
+                    "threads": threads,
+                    "bf16": bf16,
+                    "compile": compile,
+                    "warmup_seconds": warmup_seconds,
+                    "steps_per_sec": steps / seconds,
+                    "real_tokens_per_sec": real_tokens / seconds,
+                })
+    torch.set_num_threads(default_threads)
+
+    results = pd.DataFrame(results)
+    logger.info('\n' + results.to_string(index=False))
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchCPU()
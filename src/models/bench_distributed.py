@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from transformers import TrainingArguments
+from bench_training import SyntheticShards, small_model, PAD_TOKEN_ID
+from train_model import (MemmapLyricsDataset, DynamicPaddingCollator, LengthBucketSampler, LyricsTrainer,
+                         ThroughputCallback, cpu_training_args, split_indices)
+
+
+class RecordingDataset(torch.utils.data.Dataset):
+    """
+        Wraps a dataset to record the indices of the examples this process was given.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.seen = []
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        self.seen.append(int(i))
+        return self.dataset[i]
+
+    @property
+    def lengths(self):
+        return self.dataset.lengths
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _train(rank, world_size, port, outdir, n, batch_size, block_size):
+    # what torchrun sets for each process it launches
+    os.environ.update({"MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port), "RANK": str(rank),
+                       "LOCAL_RANK": str(rank), "WORLD_SIZE": str(world_size), "LOCAL_WORLD_SIZE": str(world_size)})
+    shards = SyntheticShards(n)
+    train_indices, eval_indices = split_indices(n, test_size=0.1, seed=0)
+    train_dataset = RecordingDataset(MemmapLyricsDataset(shards, block_size, PAD_TOKEN_ID, train_indices,
+                                                         pad_to_block=False))
+    eval_dataset = MemmapLyricsDataset(shards, block_size, PAD_TOKEN_ID, eval_indices, pad_to_block=False)
+
+    args = TrainingArguments(output_dir=os.path.join(outdir, "results"), num_train_epochs=1, logging_steps=2,
+                             save_strategy="no", report_to=[], disable_tqdm=True, seed=0,
+                             **cpu_training_args(bf16=False, batch_size=batch_size,
+                                                 global_batch_size=batch_size * world_size))
+    throughput_logger = ThroughputCallback(os.path.join(outdir, f"telemetry-{world_size}.jsonl"))
+    trainer = LyricsTrainer(model=small_model(block_size), args=args, train_dataset=train_dataset,
+                            eval_dataset=eval_dataset, data_collator=DynamicPaddingCollator(PAD_TOKEN_ID),
+                            callbacks=[throughput_logger],
+                            train_sampler=LengthBucketSampler(train_dataset.lengths, batch_size))
+
+    initial_eval_loss = trainer.evaluate()["eval_loss"]
+    start = time.perf_counter()
+    train_loss = trainer.train().training_loss
+    seconds = time.perf_counter() - start
+    with open(os.path.join(outdir, f"rank-{world_size}-{rank}.json"), "w") as f:
+        json.dump({"seen": train_dataset.seen, "initial_eval_loss": initial_eval_loss, "train_loss": train_loss,
+                   "seconds": seconds, "steps": trainer.state.global_step,
+                   "telemetry": throughput_logger.get_metrics()}, f)
+
+
+def benchDistributed(world_sizes=(1, 2), n=560, batch_size=8, block_size=128):
+    """
+        Trains a small GPT-2 for an epoch on synthetic shards in 1 and N local processes (distributed data parallel
+        over gloo, as launched by torchrun), with the same global batch, and checks that the processes
+        train on disjoint shards of the data covering it (but for the padding of the last batches),
+        evaluate to the same loss as a single process and that only the first one writes the telemetry.
+        Reports the steps/sec and tokens/sec of each.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info(f'benchmarking distributed training with {world_sizes} processes on {n} documents')
+    results = []
+    problems = []
+    with tempfile.TemporaryDirectory() as outdir:
+        for world_size in world_sizes:
+            mp.spawn(_train, args=(world_size, _free_port(), outdir, n, batch_size, block_size), nprocs=world_size)
+            ranks = []
+            for rank in range(world_size):
+                with open(os.path.join(outdir, f"rank-{world_size}-{rank}.json")) as f:
+                    ranks.append(json.load(f))
+
+            # the last round of batches is padded with examples from the start, so every process gets one
+            seen = [r["seen"] for r in ranks]
+            distinct = set().union(*seen)
+            if sum(len(s) for s in seen) - len(distinct) > (world_size - 1) * batch_size:
+                problems.append(f"{world_size} processes trained on overlapping examples")
+            if len(distinct) != n - int(np.ceil(0.1 * n)):
+                problems.append(f"{world_size} processes didn't cover the training examples")
+            if not np.allclose([r["initial_eval_loss"] for r in ranks], results[0]["initial_eval_loss"]
+                               if results else ranks[0]["initial_eval_loss"], rtol=1e-4):
+                problems.append(f"{world_size} processes evaluated to another loss than a single one")
+            with open(os.path.join(outdir, f"telemetry-{world_size}.jsonl")) as f:
+                written = len(f.readlines())
+            if written != len(ranks[0]["telemetry"]):
+                problems.append(f"{world_size} processes wrote {written} telemetry records, "
+                                f"not {len(ranks[0]['telemetry'])}")
+
+            seconds = max(r["seconds"] for r in ranks)
+            tokens = sum(record["tokens"] for record in ranks[0]["telemetry"])
+            results.append({
+                "processes": world_size,
+                "steps": ranks[0]["steps"],
+                "initial_eval_loss": ranks[0]["initial_eval_loss"],
+                "train_loss": ranks[0]["train_loss"],
+                "steps_per_sec": ranks[0]["steps"] / seconds,
+                "real_tokens_per_sec": tokens / seconds,
+            })
+
+    results = pd.DataFrame(results)
+    logger.info('\n' + results.to_string(index=False))
+    if problems:
+        raise ValueError(f"Distributed training is inconsistent: {problems}")
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchDistributed()
@@ -0,0 +1,67 @@
+import time
+import logging
+import numpy as np
+import pandas as pd
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+from bench_training import load_shards, VOCAB_SIZE
+from train_model import cpu_bf16_supported
+from evaluate_model import sliding_windows, window_nll
+
+
+def _naive_nll(model, shards, windows):
+    # one window at a time through the logits of every position, as the usual sliding window recipe does
+    nll, tokens = 0.0, 0
+    with torch.inference_mode():
+        for doc, begin, end, score_begin in windows:
+            input_ids = torch.from_numpy(shards[doc][begin:end].astype(np.int64))[None]
+            labels = input_ids.clone()
+            labels[:, :score_begin - begin] = -100
+            predicted = end - score_begin
+            nll += model(input_ids=input_ids, labels=labels).loss.item() * predicted
+            tokens += predicted
+    return nll, tokens
+
+
+def benchEvaluation(n=200, max_length=1024, stride=512, max_batch_tokens=None):
+    """
+        Scores n documents (the exported token shards, else synthetic ones) with a GPT-2 sized model
+        (randomly initialized, 124M parameters) with sliding windows: one window at a time through the full
+        logits, and with window_nll (windows batched across documents, only the predicted positions through
+        the output layer) in float32 and, where the CPU supports it, bf16 autocast.
+        Checks the float32 perplexities agree and reports tokens/sec.
+    """
+    logger = logging.getLogger(__name__)
+    max_batch_tokens = max_batch_tokens or 1024 * torch.get_num_threads()
+    shards = load_shards(n)
+    docs = range(min(n, len(shards)))
+    windows = [(doc, *window) for doc in docs for window in sliding_windows(len(shards[doc]), max_length, stride)]
+    logger.info(f'benchmarking perplexity evaluation of {len(docs)} documents in {len(windows)} windows')
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=VOCAB_SIZE, n_positions=1024)).eval()
+    modes = ["naive", "batched"] + (["batched bf16"] if cpu_bf16_supported() else [])
+    results = []
+    for mode in modes:
+        start = time.perf_counter()
+        if mode == "naive":
+            nll, tokens = _naive_nll(model, shards, windows)
+        else:
+            nll, tokens = window_nll(model, shards, windows, max_batch_tokens, bf16=mode.endswith("bf16"))
+            nll, tokens = nll.sum(), int(tokens.sum())
+        seconds = time.perf_counter() - start
+        results.append({"mode": mode, "tokens": tokens, "perplexity": float(np.exp(nll / tokens)),
+                        "seconds": seconds, "tokens_per_sec": tokens / seconds})
+
+    results = pd.DataFrame(results)
+    logger.info('\n' + results.to_string(index=False))
+    if not np.isclose(results["perplexity"][0], results["perplexity"][1], rtol=1e-4):
+        raise ValueError("Batched evaluation doesn't give the perplexity of one window at a time")
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchEvaluation()
@@ -0,0 +1,80 @@
+import os
+import time
+import logging
+import tempfile
+import torch
+import pandas as pd
+from transformers import GPT2Config, GPT2LMHeadModel
+from bench_training import load_shards, CountingCollator, PAD_TOKEN_ID, VOCAB_SIZE
+from train_model import MemmapLyricsDataset, DynamicPaddingCollator, LengthBucketSampler
+from lora import add_lora, save_adapter
+
+# the vocabulary of GPT-2 before the tags of the prompts were added
+BASE_VOCAB_SIZE = 50257
+
+
+def _dir_mb(dirpath):
+    return sum(os.path.getsize(os.path.join(dirpath, name)) for name in os.listdir(dirpath)) / 2**20
+
+
+def benchLoRA(steps=5, batch_size=8, block_size=128, n=2000, lora_rank=8):
+    """
+        Compares fine-tuning every weight of a GPT-2 sized model (randomly initialized, 124M parameters)
+        against training LoRA adapters of rank lora_rank on it: trainable parameters, AdamW state,
+        saved checkpoint size and training steps/sec on the dynamically padded, length bucketed batches.
+    """
+    logger = logging.getLogger(__name__)
+    shards = load_shards(n)
+    dataset = MemmapLyricsDataset(shards, block_size, PAD_TOKEN_ID, pad_to_block=False)
+    logger.info(f'benchmarking LoRA (rank {lora_rank}) against full fine-tuning on {steps} batches of {batch_size}')
+
+    results = []
+    for lora in (False, True):
+        torch.manual_seed(0)
+        model = GPT2LMHeadModel(GPT2Config(vocab_size=VOCAB_SIZE, n_positions=1024))
+        if lora:
+            add_lora(model, r=lora_rank, trainable_from=BASE_VOCAB_SIZE)
+        trainable = [param for param in model.parameters() if param.requires_grad]
+        optimizer = torch.optim.AdamW(trainable, lr=2e-4 if lora else 5e-5)
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, sampler=LengthBucketSampler(dataset.lengths, batch_size),
+            collate_fn=CountingCollator(DynamicPaddingCollator(PAD_TOKEN_ID)))
+
+        model.train()
+        batches = iter(loader)
+        # the first step allocates the optimizer state, left out of the timing
+        for step in range(steps + 1):
+            if step == 1:
+                start = time.perf_counter()
+            batch, _ = next(batches)
+            model(**batch).loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        seconds = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if lora:
+                save_adapter(model, tmpdir)
+            else:
+                model.save_pretrained(tmpdir)
+            checkpoint_mb = _dir_mb(tmpdir)
+
+        results.append({
+            "mode": f"lora r={lora_rank}" if lora else "full",
+            "trainable_params": sum(param.numel() for param in trainable),
+            "optimizer_state_mb": sum(value.numel() * value.element_size() for state in optimizer.state.values()
+                                      for value in state.values() if torch.is_tensor(value)) / 2**20,
+            "checkpoint_mb": checkpoint_mb,
+            "steps_per_sec": steps / seconds,
+        })
+
+    results = pd.DataFrame(results)
+    logger.info('\n' + results.to_string(index=False))
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchLoRA()
@@ -0,0 +1,98 @@
+import time
+import logging
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from transformers import GPT2Config, GPT2LMHeadModel
+from bench_training import VOCAB_SIZE
+from memory_budget import fit_micro_batch, memory_profile, training_memory_mb, pin_mmap_threshold
+from instrumentation import peak_rss_mb
+
+
+# GPT-2 sized, and a small model with the same vocabulary whose memory goes mostly to the logits and the loss
+MODELS = {
+    "gpt2": {},
+    "small": {"n_layer": 2, "n_head": 4, "n_embd": 256},
+}
+
+
+def _train(queue, model_name, block_size, memory_budget_mb, batch_size, gradient_checkpointing, bf16, steps):
+    # as train_model.main does with a memory budget on CPU
+    pin_mmap_threshold()
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=VOCAB_SIZE, n_positions=1024, **MODELS[model_name]))
+    profile = memory_profile(model, block_size, gradient_checkpointing, bf16=bf16, memory_budget_mb=memory_budget_mb)
+    record = {"model": model_name, "block_size": block_size, "gradient_checkpointing": gradient_checkpointing,
+              "bf16": bf16, "memory_budget_mb": memory_budget_mb}
+    try:
+        micro_batch, accumulation_steps = fit_micro_batch(profile, memory_budget_mb, batch_size)
+    except ValueError:
+        queue.put({**record, "micro_batch": None})
+        return
+    optimizer = torch.optim.AdamW(model.parameters(), lr=5e-5)
+    model.train()
+    # full blocks, the longest batches dynamic padding makes
+    input_ids = torch.randint(0, VOCAB_SIZE, (micro_batch, block_size))
+    start = time.perf_counter()
+    for _ in range(steps):
+        for _ in range(accumulation_steps):
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+                loss = model(input_ids=input_ids, labels=input_ids).loss
+            (loss / accumulation_steps).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    seconds = time.perf_counter() - start
+    queue.put({
+        **record,
+        "micro_batch": micro_batch,
+        "accumulation_steps": accumulation_steps,
+        "estimated_mb": training_memory_mb(profile, micro_batch),
+        "peak_rss_mb": peak_rss_mb(),
+        "tokens_per_sec": steps * batch_size * block_size / seconds,
+    })
+
+
+def benchMemoryBudget(memory_budget_mb=5000, block_sizes=(128, 512, 1024), batch_size=16, steps=1,
+                      logits_budget_mb=3000, logits_block_size=256, logits_batch_size=32):
+    """
+        Fits the micro-batch of a GPT-2 sized model (randomly initialized, 124M parameters) to memory_budget_mb
+        for each block size, with and without gradient checkpointing, then trains steps optimizer steps
+        of batch_size full length examples in a fresh process and checks that its peak memory stays
+        within the budget (an OOM-killed process fails too). The same for a small model whose memory goes
+        mostly to the logits (2 blocks, GPT-2's vocabulary), on logits_batch_size examples of logits_block_size
+        tokens with gradient checkpointing, in fp32 and bf16 autocast, within logits_budget_mb.
+        Reports the micro-batches (None when not even one example fits), estimated and measured peaks and tokens/sec.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info(f'benchmarking micro-batch fitting to {memory_budget_mb} MiB for blocks of {block_sizes} tokens '
+                f'and of a logits dominated model to {logits_budget_mb} MiB')
+    runs = [("gpt2", block_size, memory_budget_mb, batch_size, gradient_checkpointing, False)
+            for block_size in block_sizes for gradient_checkpointing in (False, True)]
+    runs.extend(("small", logits_block_size, logits_budget_mb, logits_batch_size, True, bf16) for bf16 in (False, True))
+
+    context = mp.get_context("spawn")
+    results = []
+    for model_name, block_size, budget_mb, examples, gradient_checkpointing, bf16 in runs:
+        queue = context.Queue()
+        process = context.Process(target=_train, args=(queue, model_name, block_size, budget_mb, examples,
+                                                       gradient_checkpointing, bf16, steps))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise ValueError(f"Training {model_name} on blocks of {block_size} tokens (gradient checkpointing "
+                             f"{gradient_checkpointing}, bf16 {bf16}) failed with exit code {process.exitcode}")
+        results.append(queue.get())
+
+    results = pd.DataFrame(results)
+    logger.info('\n' + results.to_string(index=False))
+    over = results[results["peak_rss_mb"] > results["memory_budget_mb"]]
+    if len(over):
+        raise ValueError(f"Training went over its memory budget:\n{over.to_string(index=False)}")
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchMemoryBudget()
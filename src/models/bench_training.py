@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import logging
+import numpy as np
+import pandas as pd
+import torch
+from pathlib import Path
+from transformers import GPT2Config, GPT2LMHeadModel
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+sys.path.append(os.path.join(PROJECT_DIR, "src", "data"))
+from tokens import TokenShards, TOKENS_DIR
+from train_model import (MemmapLyricsDataset, DynamicPaddingCollator, LengthBucketSampler,
+                         PackedLyricsDataset, PackingCollator)
+
+PAD_TOKEN_ID = 50256
+VOCAB_SIZE = 50261
+
+
+class SyntheticShards:
+    """
+        Stand-in for TokenShards when no shards were exported: random token ids with
+        lyrics-like lengths (lognormal, mostly shorter than a block, some much longer).
+    """
+
+    def __init__(self, n, seed=0):
+        rng = np.random.default_rng(seed)
+        self.lengths = np.clip(rng.lognormal(4.3, 0.8, n).astype(np.int64), 8, 2048)
+        self.docs = [rng.integers(0, PAD_TOKEN_ID, length).astype(np.uint16) for length in self.lengths]
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __getitem__(self, i):
+        return self.docs[i]
+
+
+def load_shards(n):
+    if os.path.exists(os.path.join(TOKENS_DIR, "meta.json")):
+        return TokenShards(TOKENS_DIR)
+    return SyntheticShards(n)
+
+
+def small_model(block_size, seed=0):
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=VOCAB_SIZE, n_positions=max(block_size, 1024), n_layer=2, n_head=4, n_embd=256)
+    return GPT2LMHeadModel(config)
+
+
+class CountingCollator:
+    """
+        Wraps a collator (the default one if None) to also return the real tokens (padding excluded) of the batch.
+    """
+
+    def __init__(self, collator=None):
+        self.collator = collator or torch.utils.data.default_collate
+
+    def __call__(self, examples):
+        real_tokens = sum(int(example['attention_mask'].sum()) if 'attention_mask' in example
+                          else len(example['input_ids']) for example in examples)
+        return self.collator(examples), real_tokens
+
+
+def run_batches(model, loader, steps, bf16=False):
+    """
+        Trains model on `steps` batches of loader (with the forward autocast to bf16 on CPU if bf16)
+        and returns the wall time and the real (attended) and padded tokens it went through.
+    """
+    optimizer = torch.optim.AdamW(model.parameters(), lr=5e-5)
+    model.train()
+    real_tokens = padded_tokens = 0
+    start = time.perf_counter()
+    for step, (batch, batch_tokens) in enumerate(loader):
+        if step == steps:
+            break
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+            loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        real_tokens += batch_tokens
+        padded_tokens += batch['input_ids'].numel()
+    return time.perf_counter() - start, real_tokens, padded_tokens
+
+
+def benchPadding(steps=20, batch_size=32, block_size=128, n=5000):
+    """
+        Compares the training throughput of fixed padding to block_size against dynamic padding,
+        with and without length bucketing, and packing, on the exported token shards (or synthetic ones)
+        with a small GPT-2, in real tokens (padding excluded) per second, along with the steps an epoch takes.
+    """
+    logger = logging.getLogger(__name__)
+    shards = load_shards(n)
+    logger.info(f'benchmarking padding on {steps} batches of {batch_size} examples from {len(shards)} documents')
+
+    results = []
+    for padding, length_buckets in (("max_length", False), ("dynamic", False), ("dynamic", True), ("packed", False)):
+        if padding == "packed":
+            dataset = PackedLyricsDataset(shards, block_size)
+        else:
+            dataset = MemmapLyricsDataset(shards, block_size, PAD_TOKEN_ID, pad_to_block=padding == "max_length")
+        if length_buckets:
+            sampler = LengthBucketSampler(dataset.lengths, batch_size)
+        else:
+            sampler = torch.utils.data.RandomSampler(dataset, generator=torch.Generator().manual_seed(0))
+        collator = {"dynamic": DynamicPaddingCollator(PAD_TOKEN_ID), "packed": PackingCollator(PAD_TOKEN_ID)}.get(padding)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                                             collate_fn=CountingCollator(collator))
+
+        seconds, real_tokens, padded_tokens = run_batches(small_model(block_size), loader, steps)
+        results.append({
+            "padding": padding,
+            "length_buckets": length_buckets,
+            "seconds": seconds,
+            "real_tokens_per_sec": real_tokens / seconds,
+            "padding_share": 1 - real_tokens / padded_tokens,
+            "steps_per_epoch": len(loader),
+        })
+
+    results = pd.DataFrame(results)
+    logger.info('\n' + results.to_string(index=False))
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    benchPadding()
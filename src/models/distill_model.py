@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from pathlib import Path
+from transformers import GPT2Config, GPT2LMHeadModel, TrainingArguments, EarlyStoppingCallback
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+sys.path.append(os.path.join(PROJECT_DIR, "src", "data"))
+from instrumentation import PROFILE_DIR
+from train_model import (LyricsTrainer, DynamicPaddingCollator, LengthBucketSampler, load_datasets, lyrics_file_path,
+                         cpu_training_args, BLOCK_SIZE)
+from evaluate_model import load_model
+
+TEACHER_DIR = Path(os.path.join(PROJECT_DIR, "models", "gpt2"))
+STUDENT_DIR = Path(os.path.join(PROJECT_DIR, "models", "gpt2_student"))
+
+
+def make_student(teacher, n_layer=6):
+    """
+        A GPT-2 with n_layer blocks initialized from evenly spaced blocks of the teacher (the first and last included)
+        and sharing its embeddings, so it keeps the teacher's vocabulary, special tokens and tokenizer.
+        With 6 blocks of the 12 of GPT-2 it has the size of distilgpt2.
+    """
+    if not 0 < n_layer <= teacher.config.n_layer:
+        raise ValueError(f"The student needs between 1 and {teacher.config.n_layer} blocks, not {n_layer}")
+    student = GPT2LMHeadModel(GPT2Config.from_dict({**teacher.config.to_dict(), "n_layer": n_layer}))
+    blocks = np.linspace(0, teacher.config.n_layer - 1, n_layer).round().astype(int)
+
+    teacher_state = teacher.state_dict()
+    state = {name: value.clone() for name, value in teacher_state.items() if not name.startswith("transformer.h.")}
+    for block, teacher_block in enumerate(blocks):
+        prefix = f"transformer.h.{teacher_block}."
+        state.update({f"transformer.h.{block}.{name[len(prefix):]}": value.clone()
+                      for name, value in teacher_state.items() if name.startswith(prefix)})
+    student.load_state_dict(state)
+    return student
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature=2.0, alpha=0.5):
+    """
+        alpha * the KL divergence of the student's next token distributions from the teacher's, both softened
+        by temperature (scaled by its square so the gradients keep their size), plus (1 - alpha) * the cross entropy
+        of the student with the labels, over the positions that predict a label.
+    """
+    labels = labels[:, 1:]
+    predicted = labels != -100
+    student_logits = student_logits[:, :-1][predicted].float()
+    teacher_logits = teacher_logits[:, :-1][predicted].float()
+    kl = F.kl_div(F.log_softmax(student_logits / temperature, dim=-1), F.log_softmax(teacher_logits / temperature, dim=-1),
+                  log_target=True, reduction="batchmean") * temperature**2
+    return alpha * kl + (1 - alpha) * F.cross_entropy(student_logits, labels[predicted])
+
+
+class DistillationTrainer(LyricsTrainer):
+    """
+        Trains the model (the student) on distillation_loss against the frozen teacher's predictions.
+        Evaluation keeps the student's own cross entropy, comparable with the teacher's.
+    """
+
+    def __init__(self, *args, teacher=None, temperature=2.0, alpha=0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.teacher = teacher.to(self.args.device).eval()
+        for param in self.teacher.parameters():
+            param.requires_grad = False
+        self.temperature = temperature
+        self.alpha = alpha
+        # compute_loss returns the mean over its batch, still to be divided by the gradient accumulation steps
+        self.loss_is_scaled_for_ga = False
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        outputs = model(**inputs)
+        if not model.training:
+            loss = outputs.loss
+        else:
+            with torch.no_grad():
+                teacher_logits = self.teacher(**inputs).logits
+            loss = distillation_loss(outputs.logits, teacher_logits, inputs['labels'], self.temperature, self.alpha)
+        return (loss, outputs) if return_outputs else loss
+
+
+def perplexity(model, dataset, collator, batch_size=8):
+    """
+        exp of the mean negative log-likelihood of model over every predicted token of dataset.
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    nll, tokens = 0.0, 0
+    with torch.no_grad():
+        for batch in torch.utils.data.DataLoader(dataset, batch_size=batch_size, collate_fn=collator):
+            batch = {key: value.to(device) for key, value in batch.items()}
+            labels = batch.pop('labels')[:, 1:]
+            logits = model(**batch).logits[:, :-1]
+            predicted = labels != -100
+            nll += F.cross_entropy(logits[predicted].float(), labels[predicted], reduction="sum").item()
+            tokens += int(predicted.sum())
+    return float(np.exp(nll / tokens))
+
+
+def decode_tokens_per_sec(model, prompts, pad_token_id, new_tokens=64, seed=0):
+    """
+        Tokens per second model generates from each prompt in turn, sampling like predict_model.generate_lyrics,
+        new_tokens tokens per prompt. A first generation warms up before the timing.
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    torch.manual_seed(seed)
+    generated = 0
+    start = None
+    with torch.no_grad():
+        for prompt in [prompts[0]] + list(prompts):
+            input_ids = torch.as_tensor(prompt, device=device)[None]
+            output_ids = model.generate(input_ids, attention_mask=torch.ones_like(input_ids),
+                                        max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=True,
+                                        top_k=50, top_p=0.9, temperature=0.8, pad_token_id=pad_token_id)
+            if start is None:
+                start = time.perf_counter()
+            else:
+                generated += output_ids.shape[1] - input_ids.shape[1]
+    return generated / (time.perf_counter() - start)
+
+
+def eval_prompts(dataset, n=8, prompt_tokens=16):
+    """
+        The first prompt_tokens tokens (padding excluded) of the first n examples of dataset.
+    """
+    prompts = []
+    for i in range(min(n, len(dataset))):
+        example = dataset[i]
+        length = int(example['attention_mask'].sum()) if 'attention_mask' in example else len(example['input_ids'])
+        prompts.append(example['input_ids'][:min(length, prompt_tokens)].tolist())
+    return prompts
+
+
+def compare(models, eval_dataset, collator, pad_token_id, n_prompts=8, new_tokens=64):
+    """
+        Side by side perplexity on eval_dataset and decode tokens/sec of models, a {name: model} dict.
+    """
+    prompts = eval_prompts(eval_dataset, n_prompts)
+    return pd.DataFrame([{
+        "model": name,
+        "layers": model.config.n_layer,
+        "params": sum(param.numel() for param in model.parameters()),
+        "perplexity": perplexity(model, eval_dataset, collator),
+        "decode_tokens_per_sec": decode_tokens_per_sec(model, prompts, pad_token_id, new_tokens),
+    } for name, model in models.items()])
+
+
+def main(n_layer=6, teacher_dirpath=TEACHER_DIR, student_dirpath=STUDENT_DIR, temperature=2.0, alpha=0.5, cpu=None,
+         block_size=BLOCK_SIZE):
+    """
+        Distills the fine-tuned GPT-2 in teacher_dirpath (loaded as evaluate_model.load_model does, a LoRA adapter
+        merged into its base model included, with its tokenizer) into a student of n_layer blocks trained
+        on the same lyrics in blocks of block_size tokens (training's by default), saved in student_dirpath,
+        and reports the perplexity and decode tokens/sec of both on the validation songs.
+    """
+    logger = logging.getLogger(__name__)
+    teacher, tokenizer = load_model(teacher_dirpath)
+    student = make_student(teacher, n_layer)
+    logger.info(f'distilling a {teacher.config.n_layer} block teacher into a {n_layer} block student')
+
+    if cpu is None:
+        cpu = not torch.cuda.is_available()
+    device_args = cpu_training_args() if cpu else {"per_device_train_batch_size": 32, "per_device_eval_batch_size": 32}
+    training_args = TrainingArguments(
+        output_dir='./results/student',
+        eval_strategy="epoch",
+        save_strategy="epoch",
+        logging_strategy="epoch",
+        num_train_epochs=10,
+        warmup_steps=500,
+        learning_rate=5e-5,
+        save_total_limit=1,
+        load_best_model_at_end=True,
+        metric_for_best_model='loss',
+        greater_is_better=False,
+        report_to=[],
+        **device_args
+    )
+
+    # the teacher's split (same SPLIT_SEED), so the student isn't evaluated on songs the teacher learnt
+    with training_args.main_process_first(desc="loading the data"):
+        train_dataset, eval_dataset = load_datasets(tokenizer, block_size, test_size=0.1, file_path=lyrics_file_path(),
+                                                    pad_to_block=False)
+    data_collator = DynamicPaddingCollator(tokenizer.pad_token_id)
+
+    trainer = DistillationTrainer(
+        model=student,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        data_collator=data_collator,
+        callbacks=[EarlyStoppingCallback(early_stopping_patience=3)],
+        train_sampler=LengthBucketSampler(train_dataset.lengths, training_args.per_device_train_batch_size),
+        teacher=teacher,
+        temperature=temperature,
+        alpha=alpha,
+    )
+    trainer.train()
+    if not trainer.is_world_process_zero():
+        return
+
+    student.save_pretrained(os.path.join(student_dirpath, "model"))
+    tokenizer.save_pretrained(os.path.join(student_dirpath, "tokenizer"))
+
+    results = compare({"teacher": teacher, "student": student}, eval_dataset, data_collator, tokenizer.pad_token_id)
+    logger.info('\n' + results.to_string(index=False))
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, "distillation.json"), "w") as f:
+        json.dump(results.to_dict(orient="records"), f, indent=4)
+    return results
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
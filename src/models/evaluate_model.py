@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from pathlib import Path
+from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+sys.path.append(os.path.join(PROJECT_DIR, "src", "data"))
+from storage import read_dataset
+from tokens import (TokenShards, TokenShardWriter, tokenize_texts, tokenizer_hash, prompts_hash, shards_exist,
+                    TOKENS_DIR, TOKEN_CACHE_DIR)
+from train_model import split_indices, host_cpus, cpu_bf16_supported, SPLIT_SEED
+from lora import from_adapter, ADAPTER_CONFIG
+
+MODEL_DIR = Path(os.path.join(PROJECT_DIR, "models", "gpt2"))
+FEATURES_FILEPATH = Path(os.path.join(PROJECT_DIR, "data", "features", "lyrics_features.csv"))
+REPORT_FILEPATH = Path(os.path.join(PROJECT_DIR, "reports", "evaluation", "perplexity.csv"))
+
+
+def load_model(model_dirpath=MODEL_DIR):
+    """
+        The model in /model_dirpath/model, or the LoRA adapter in /model_dirpath/adapter merged into its base model
+        when there is one (as predict_model.py loads them), and the tokenizer in /model_dirpath/tokenizer.
+    """
+    adapter_dirpath = os.path.join(model_dirpath, "adapter")
+    if os.path.exists(os.path.join(adapter_dirpath, ADAPTER_CONFIG)):
+        model = from_adapter(adapter_dirpath)
+    else:
+        model = GPT2LMHeadModel.from_pretrained(os.path.join(model_dirpath, "model"))
+    return model, GPT2TokenizerFast.from_pretrained(os.path.join(model_dirpath, "tokenizer"))
+
+
+class EvalSongs:
+    """
+        The validation songs of a features data set, with their genre and artist: the test_size of its prompts
+        split off with seed (training's SPLIT_SEED), the songs training holds out of the token shards
+        in tokens_dirpath exported from it (csv features, whose rows are in the order they were tokenized).
+        Raises ValueError when the prompts of the features aren't the ones the shards were tokenized from,
+        in the same order (e.g. the features were built again without exporting the shards), as the split
+        would then hold out other songs than training did. They are tokenized at full length
+        once and cached as token shards in cache_dirpath, under a key of their prompts and the tokenizer.
+    """
+
+    def __init__(self, tokenizer, features_filepath=FEATURES_FILEPATH, test_size=0.1, seed=SPLIT_SEED,
+                 tokens_dirpath=TOKENS_DIR, cache_dirpath=TOKEN_CACHE_DIR, n_workers=None):
+        songs = read_dataset(features_filepath, columns=['tag', 'artist', 'final_lyrics'])
+        prompts = songs['final_lyrics'].astype(str).tolist()
+        exported = TokenShards(tokens_dirpath)
+        if len(prompts) != len(exported) or prompts_hash(prompts) != exported.meta.get("prompts_hash"):
+            raise ValueError(f"The {len(prompts)} prompts of {features_filepath} aren't the {len(exported)} "
+                             f"training read from {tokens_dirpath}, so the validation songs can't be told apart. "
+                             "Please build the features and export the token shards again, then retrain.")
+        _, eval_indices = split_indices(len(songs), test_size, seed)
+        songs = songs.iloc[np.sort(eval_indices)]
+        self.genres = songs['tag'].astype(str).to_numpy()
+        self.artists = songs['artist'].astype(str).to_numpy()
+
+        texts = songs['final_lyrics'].astype(str).tolist()
+        sha = hashlib.sha256(tokenizer_hash(tokenizer).encode())
+        for text in texts:
+            sha.update(text.encode())
+            sha.update(b"\0")
+        shards_dirpath = Path(cache_dirpath) / f"eval-{sha.hexdigest()[:32]}"
+        if not shards_exist(shards_dirpath):
+            n_workers = n_workers or min(os.cpu_count() or 1, 1 + len(texts) // 10**4)
+            with TokenShardWriter(shards_dirpath, tokenizer_ckpt=tokenizer.name_or_path, tokenizer=tokenizer) as writer:
+                writer.add_ids(tokenize_texts(tokenizer, texts, n_workers=n_workers))
+        self.shards = TokenShards(shards_dirpath, tokenizer_ckpt=None)
+
+    def __len__(self):
+        return len(self.shards)
+
+
+def sliding_windows(length, max_length=1024, stride=512, score_from=1):
+    """
+        (begin, end, score_begin) windows over a document of length tokens: at most max_length tokens each,
+        starting stride tokens apart, each predicting the tokens from score_begin to end that no earlier
+        one did. So every token from score_from on is predicted once, after the first window
+        with at least max_length - stride tokens of context.
+    """
+    if not 0 < stride <= max_length:
+        raise ValueError(f"The stride must be between 1 and max_length ({max_length}), not {stride}")
+    windows = []
+    begin, scored = 0, max(1, score_from)
+    while scored < length:
+        end = min(begin + max_length, length)
+        if end > scored:
+            windows.append((begin, end, scored))
+            scored = end
+        begin += stride
+    return windows
+
+
+def window_nll(model, shards, windows, max_batch_tokens=1024, bf16=False, chunk_tokens=2048):
+    """
+        Summed negative log-likelihood and number of predicted tokens of each (document, begin, end, score_begin)
+        window over shards. Windows of similar lengths are batched together, longest first, up to
+        max_batch_tokens tokens padding included, and only the hidden states of the predicted tokens go through
+        the output layer, chunk_tokens at a time, instead of the logits of every position.
+    """
+    device = next(model.parameters()).device
+    lengths = np.array([end - begin for _, begin, end, _ in windows])
+    order = np.argsort(-lengths, kind="stable")
+    nll = np.zeros(len(windows))
+    tokens = np.zeros(len(windows), dtype=np.int64)
+
+    model.eval()
+    with torch.inference_mode(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16):
+        start = 0
+        while start < len(order):
+            batch = order[start:start + max(1, max_batch_tokens // lengths[order[start]])]
+            start += len(batch)
+            # padding goes after the tokens of a window, which causal attention keeps them from seeing,
+            # so no attention mask (which would take attention off its fast causal path) and any token id will do
+            input_ids = torch.zeros(len(batch), lengths[batch[0]], dtype=torch.long)
+            rows, positions = [], []
+            for row, window in enumerate(batch):
+                doc, begin, end, score_begin = windows[window]
+                input_ids[row, :end - begin] = torch.from_numpy(shards[doc][begin:end].astype(np.int64))
+                # the hidden state at a position predicts the token after it
+                positions.append(torch.arange(score_begin - begin - 1, end - begin - 1))
+                rows.append(torch.full_like(positions[-1], row))
+            rows, positions = torch.cat(rows), torch.cat(positions)
+            targets = input_ids[rows, positions + 1].to(device)
+
+            hidden = model.transformer(input_ids=input_ids.to(device)).last_hidden_state
+            hidden = hidden[rows.to(device), positions.to(device)]
+            losses = torch.cat([F.cross_entropy(model.lm_head(hidden[i:i + chunk_tokens]).float(),
+                                                targets[i:i + chunk_tokens], reduction="none")
+                                for i in range(0, len(hidden), chunk_tokens)])
+            nll[batch] = torch.zeros(len(batch), dtype=torch.float64).index_add_(0, rows, losses.double().cpu()).numpy()
+            tokens[batch] = np.bincount(rows.numpy(), minlength=len(batch))
+    return nll, tokens
+
+
+def _summary(songs):
+    return {
+        "songs": len(songs),
+        "tokens": int(songs["tokens"].sum()),
+        "perplexity": float(np.exp(songs["nll"].sum() / songs["tokens"].sum())),
+    }
+
+
+def perplexity_report(genres, artists, nll, tokens):
+    """
+        Perplexity (token weighted) of all the songs, of each genre and of each artist of each genre,
+        from the summed negative log-likelihood and predicted tokens of every song.
+    """
+    songs = pd.DataFrame({"genre": genres, "artist": artists, "nll": nll, "tokens": tokens})
+    songs = songs[songs["tokens"] > 0]
+    rows = [{"level": "all", "genre": None, "artist": None, **_summary(songs)}]
+    rows.extend({"level": "genre", "genre": genre, "artist": None, **_summary(group)}
+                for genre, group in songs.groupby("genre"))
+    rows.extend({"level": "artist", "genre": genre, "artist": artist, **_summary(group)}
+                for (genre, artist), group in songs.groupby(["genre", "artist"]))
+    return pd.DataFrame(rows)
+
+
+def main(model_dirpath=MODEL_DIR, features_filepath=FEATURES_FILEPATH, max_length=1024, stride=512,
+         max_batch_tokens=None, bf16=None, output_filepath=REPORT_FILEPATH, baseline_filepath=None, tolerance=0.01,
+         tokens_dirpath=TOKENS_DIR):
+    """
+        Perplexity of the model in model_dirpath (see load_model) on the full lyrics of the validation songs
+        (see EvalSongs, of the token shards training read in tokens_dirpath), overall, per genre and per artist.
+        Songs longer than max_length tokens are scored with windows stride tokens apart (see sliding_windows),
+        batched across songs, by default 1024 tokens per thread on CPU (larger batches only spill out of
+        the caches) and 16384 on GPU. Only the lyrics
+        are scored, not the tags before them. bf16 autocast is on where the CPU (or GPU) supports it (bf16=None).
+        Writes the report to output_filepath and returns it. With the report of another model
+        (e.g. the one in models/gpt2) as baseline_filepath, its perplexities are added alongside
+        and the groups whose perplexity is more than tolerance (relative) higher are logged.
+    """
+    logger = logging.getLogger(__name__)
+    model, tokenizer = load_model(model_dirpath)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if device.type == "cpu":
+        torch.set_num_threads(host_cpus())
+    if max_batch_tokens is None:
+        max_batch_tokens = 1024 * torch.get_num_threads() if device.type == "cpu" else 16384
+    if bf16 is None:
+        bf16 = torch.cuda.is_bf16_supported() if device.type == "cuda" else cpu_bf16_supported()
+    model.to(device)
+    max_length = min(max_length, model.config.n_positions)
+
+    songs = EvalSongs(tokenizer, features_filepath, tokens_dirpath=tokens_dirpath)
+    lyrics_start = tokenizer.convert_tokens_to_ids('[s:lyrics]')
+    windows = []
+    for doc in range(len(songs)):
+        ids = songs.shards[doc]
+        starts = np.flatnonzero(ids == lyrics_start)
+        score_from = int(starts[0]) + 1 if len(starts) else 1
+        windows.extend((doc, *window) for window in sliding_windows(len(ids), max_length, stride, score_from))
+
+    start = time.perf_counter()
+    nll, tokens = window_nll(model, songs.shards, windows, max_batch_tokens, bf16)
+    seconds = time.perf_counter() - start
+    docs = np.array([window[0] for window in windows], dtype=np.int64)
+    report = perplexity_report(songs.genres, songs.artists, np.bincount(docs, weights=nll, minlength=len(songs)),
+                               np.bincount(docs, weights=tokens, minlength=len(songs)).astype(np.int64))
+    logger.info(f'{len(songs)} songs, {tokens.sum()} tokens in {len(windows)} windows scored in {seconds:.1f}s '
+                f'({tokens.sum() / seconds:.0f} tokens/sec, bf16 {bf16})')
+
+    if baseline_filepath is not None:
+        baseline = pd.read_csv(baseline_filepath)[["level", "genre", "artist", "perplexity"]]
+        report = report.merge(baseline.rename(columns={"perplexity": "baseline_perplexity"}),
+                              on=["level", "genre", "artist"], how="left")
+        worse = report[report["perplexity"] > report["baseline_perplexity"] * (1 + tolerance)]
+        if len(worse):
+            logger.warning(f'worse than {baseline_filepath} on:\n' + worse.to_string(index=False))
+
+    logger.info('\n' + report[report["level"] != "artist"].to_string(index=False))
+    os.makedirs(Path(output_filepath).parent, exist_ok=True)
+    report.to_csv(output_filepath, index=False)
+    return report
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,190 @@
+import os
+import json
+import math
+import torch
+import torch.nn.functional as F
+import safetensors.torch
+from torch import nn
+from transformers import GPT2LMHeadModel
+from transformers.pytorch_utils import Conv1D
+
+ADAPTER_CONFIG = "adapter_config.json"
+ADAPTER_WEIGHTS = "adapter.safetensors"
+# the query, key and value projection of every attention block
+TARGET_MODULES = ("c_attn",)
+
+
+class LoRALayer(nn.Module):
+    """
+        Wraps a frozen linear layer (nn.Linear or GPT-2's transposed Conv1D) to add a trainable low-rank update
+        to its output, base(x) + alpha / r * x A^T B^T. B starts at zero, so it first computes what the base layer does.
+    """
+
+    def __init__(self, base, r=8, alpha=16, dropout=0.0):
+        super().__init__()
+        self.base = base
+        # Conv1D stores its weight as (in, out), nn.Linear as (out, in)
+        in_features, out_features = base.weight.shape if isinstance(base, Conv1D) else base.weight.shape[::-1]
+        self.lora_A = nn.Parameter(torch.empty(r, in_features))
+        self.lora_B = nn.Parameter(torch.zeros(out_features, r))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scaling = alpha / r
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x):
+        return self.base(x) + (self.dropout(x) @ self.lora_A.T @ self.lora_B.T) * self.scaling
+
+    def delta_weight(self):
+        delta = self.lora_B @ self.lora_A * self.scaling
+        return delta.T if isinstance(self.base, Conv1D) else delta
+
+
+class ExtendedEmbedding(nn.Module):
+    """
+        Token embedding whose rows from trainable_from on (the tokens added to the base vocabulary, like the tags
+        of the prompts) are trainable while the base ones stay frozen, without copying the whole matrix.
+    """
+
+    def __init__(self, embedding, trainable_from):
+        super().__init__()
+        self.trainable_from = trainable_from
+        self.base_weight = nn.Parameter(embedding.weight[:trainable_from].detach(), requires_grad=False)
+        self.new_rows = nn.Parameter(embedding.weight[trainable_from:].detach().clone())
+
+    @property
+    def weight(self):
+        return torch.cat([self.base_weight, self.new_rows])
+
+    def forward(self, input_ids):
+        is_new = input_ids >= self.trainable_from
+        embeds = F.embedding(input_ids.masked_fill(is_new, 0), self.base_weight)
+        new_embeds = F.embedding((input_ids - self.trainable_from).clamp(min=0), self.new_rows)
+        return torch.where(is_new[..., None], new_embeds, embeds)
+
+
+class ExtendedLMHead(nn.Module):
+    """
+        Output layer tied to an ExtendedEmbedding, like GPT-2's is to its token embedding.
+    """
+
+    def __init__(self, embedding):
+        super().__init__()
+        self.embedding = embedding
+
+    def forward(self, hidden_states):
+        return torch.cat([F.linear(hidden_states, self.embedding.base_weight),
+                          F.linear(hidden_states, self.embedding.new_rows)], dim=-1)
+
+
+def add_lora(model, r=8, alpha=16, dropout=0.05, target_modules=TARGET_MODULES, trainable_from=None):
+    """
+        Freezes the weights of a GPT-2 model and wraps its target_modules with trainable LoRALayers of rank r.
+        The embeddings of the tokens from trainable_from on (added to the base vocabulary) are trained too,
+        the base model has never seen them. Returns the model, modified in place.
+    """
+    if has_adapter(model):
+        raise ValueError("The model already has an adapter.")
+    for param in model.parameters():
+        param.requires_grad = False
+
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if name in target_modules and isinstance(child, (nn.Linear, Conv1D)):
+                setattr(module, name, LoRALayer(child, r, alpha, dropout))
+
+    vocab_size = model.get_input_embeddings().weight.shape[0]
+    if trainable_from is not None and trainable_from < vocab_size:
+        embedding = ExtendedEmbedding(model.get_input_embeddings(), trainable_from)
+        model.set_input_embeddings(embedding)
+        model.lm_head = ExtendedLMHead(embedding)
+
+    model.lora_config = {
+        "base_model": model.config.name_or_path,
+        "vocab_size": vocab_size,
+        "r": r,
+        "alpha": alpha,
+        "dropout": dropout,
+        "target_modules": list(target_modules),
+        "trainable_from": trainable_from,
+    }
+    return model
+
+
+def has_adapter(model):
+    return hasattr(model, "lora_config")
+
+
+def adapter_state_dict(model):
+    """
+        The trainable weights of the adapter of model, the only ones that differ from the base model.
+    """
+    return {name: param.detach().cpu().contiguous() for name, param in model.named_parameters() if param.requires_grad}
+
+
+def save_adapter(model, dirpath):
+    """
+        Writes the adapter weights of model to /dirpath/adapter.safetensors and the settings to rebuild it,
+        base model included, to /dirpath/adapter_config.json.
+    """
+    os.makedirs(dirpath, exist_ok=True)
+    safetensors.torch.save_file(adapter_state_dict(model), os.path.join(dirpath, ADAPTER_WEIGHTS))
+    with open(os.path.join(dirpath, ADAPTER_CONFIG), "w") as f:
+        json.dump(model.lora_config, f, indent=4)
+    return dirpath
+
+
+def load_adapter(model, dirpath):
+    """
+        Loads the adapter saved in dirpath into model, adding it first if model has none.
+        Raises ValueError when the weights don't match the adapter of model.
+    """
+    with open(os.path.join(dirpath, ADAPTER_CONFIG)) as f:
+        config = json.load(f)
+    if not has_adapter(model):
+        add_lora(model, config["r"], config["alpha"], config["dropout"], config["target_modules"],
+                 config["trainable_from"])
+
+    weights = safetensors.torch.load_file(os.path.join(dirpath, ADAPTER_WEIGHTS))
+    expected = set(adapter_state_dict(model))
+    if set(weights) != expected:
+        raise ValueError(f"The adapter in {dirpath} doesn't match the model: "
+                         f"missing {sorted(expected - set(weights))}, unexpected {sorted(set(weights) - expected)}")
+    model.load_state_dict(weights, strict=False)
+    return model
+
+
+def merge_adapter(model):
+    """
+        Folds the adapter into the base weights, leaving a plain GPT-2 model as fast as the base one.
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRALayer):
+                with torch.no_grad():
+                    child.base.weight += child.delta_weight().to(child.base.weight.dtype)
+                setattr(module, name, child.base)
+
+    embedding = model.get_input_embeddings()
+    if isinstance(embedding, ExtendedEmbedding):
+        merged = nn.Embedding.from_pretrained(embedding.weight.detach(), freeze=False)
+        model.set_input_embeddings(merged)
+        model.lm_head = nn.Linear(merged.embedding_dim, merged.num_embeddings, bias=False)
+        model.lm_head.weight = merged.weight
+
+    del model.lora_config
+    for param in model.parameters():
+        param.requires_grad = True
+    return model
+
+
+def from_adapter(dirpath, merge=True):
+    """
+        The base model an adapter was trained from (loaded by transformers) with the adapter of dirpath,
+        merged into its weights unless merge is False.
+    """
+    with open(os.path.join(dirpath, ADAPTER_CONFIG)) as f:
+        config = json.load(f)
+    model = GPT2LMHeadModel.from_pretrained(config["base_model"])
+    model.resize_token_embeddings(config["vocab_size"])
+    load_adapter(model, dirpath)
+    return merge_adapter(model) if merge else model
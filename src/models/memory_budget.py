@@ -0,0 +1,148 @@
+import os
+import sys
+import ctypes
+import logging
+import torch
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+sys.path.append(os.path.join(PROJECT_DIR, "src", "data"))
+from instrumentation import rss_mb
+
+
+def pin_mmap_threshold(threshold_bytes=2**21):
+    """
+        Makes glibc allocate every block of threshold_bytes or more with mmap, returned to the system when freed.
+        By default it raises that threshold whenever such a block is freed, after which tensors of up to 32MB
+        come from the heap, which fragments and grows over the training steps: GPT-2 with gradient checkpointing
+        on micro-batches of 4 x 512 tokens was OOM-killed past 5.4GB, pinned it peaks at 4GB.
+        Mapping the blocks anew costs some speed (about 10% there). Returns whether it could, only glibc can.
+    """
+    try:
+        libc = ctypes.CDLL("libc.so.6")
+    except OSError:
+        return False
+    # M_MMAP_THRESHOLD, which setting also stops adjusting
+    return bool(libc.mallopt(-3, threshold_bytes))
+
+
+def _tensor_mb(tensors):
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors) / 2**20
+
+
+def _activation_mb(model, batch_size, block_size, bf16=False):
+    """
+        Memory a training forward and backward of batch_size examples of block_size tokens takes
+        on top of the weights and gradients, in MiB. On GPU it is the peak allocation. CPU has no such counter,
+        so there it is the tensors autograd saves for the backward, plus what the backward of the loss
+        allocates while they are still held: three fp32 buffers the size of the logits are alive at once then,
+        the log-probabilities (saved), their gradient and the gradient of the logits.
+    """
+    device = next(model.parameters()).device
+    input_ids = torch.zeros(batch_size, block_size, dtype=torch.long, device=device)
+    weights = {param.untyped_storage().data_ptr() for param in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in weights:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16):
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            outputs = model(input_ids=input_ids, labels=input_ids)
+    # the gradients of the log-probabilities and of the logits, the log-probabilities are among the saved tensors
+    loss_backward_mb = 2 * outputs.logits.numel() * 4 / 2**20
+    outputs.loss.backward()
+    model.zero_grad(set_to_none=True)
+
+    if device.type == "cuda":
+        grads_mb = _tensor_mb(param for param in model.parameters() if param.requires_grad)
+        return (torch.cuda.max_memory_allocated(device) - start) / 2**20 - grads_mb
+    return sum(saved.values()) / 2**20 + loss_backward_mb
+
+
+def memory_profile(model, block_size, gradient_checkpointing=False, bf16=False, memory_budget_mb=None):
+    """
+        What training model on batches of block_size tokens takes in memory, in MiB:
+        static_mb for what is in memory (the weights and, on CPU, the rest of the process) with
+        the gradients and AdamW state of the trainable parameters, and base_mb + per_example_mb per example
+        for the activations, measured on batches of 1 and 2 examples and extrapolated linearly.
+        The batch of 2 is only tried when it fits in memory_budget_mb, else all the activations of
+        one example count as per example, an upper bound.
+        gradient_checkpointing enables it on model. Only the inputs of the blocks are kept then,
+        but backward recomputes the blocks one at a time and holds the activations of one of them.
+        On CPU, what is in memory is the resident memory of the process after the probes: a first training step
+        pages in the code of the kernels and the allocator keeps some of the memory it freed, which took
+        GPT-2 with LoRA from 1175 to 1630 MiB before any activation.
+    """
+    device = next(model.parameters()).device
+    if device.type == "cuda":
+        in_memory_mb = torch.cuda.memory_allocated(device) / 2**20
+    else:
+        in_memory_mb = rss_mb() or _tensor_mb(model.parameters())
+
+    training = model.training
+    model.train()
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+    trainable_mb = _tensor_mb(param for param in model.parameters() if param.requires_grad)
+    static_mb = in_memory_mb + 3 * trainable_mb
+    activations = [_activation_mb(model, 1, block_size, bf16)]
+    if memory_budget_mb is None or static_mb + 2 * activations[0] <= memory_budget_mb:
+        activations.append(_activation_mb(model, 2, block_size, bf16))
+    else:
+        activations.append(2 * activations[0])
+    per_example_mb = activations[1] - activations[0]
+    base_mb = max(0.0, activations[0] - per_example_mb)
+    if gradient_checkpointing:
+        block = model.transformer.h[0]
+        block.gradient_checkpointing = False
+        per_example_mb += _activation_mb(model, 1, block_size, bf16) - activations[0]
+        block.gradient_checkpointing = True
+    model.train(training)
+    if device.type == "cpu":
+        static_mb = max(in_memory_mb, rss_mb() or 0.0) + 3 * trainable_mb
+
+    return {
+        "block_size": block_size,
+        "gradient_checkpointing": gradient_checkpointing,
+        "static_mb": static_mb,
+        "base_mb": base_mb,
+        "per_example_mb": per_example_mb,
+    }
+
+
+def training_memory_mb(profile, batch_size):
+    """
+        Peak memory of training on micro-batches of batch_size examples, by the memory_profile profile.
+    """
+    return profile["static_mb"] + profile["base_mb"] + batch_size * profile["per_example_mb"]
+
+
+def fit_micro_batch(profile, memory_budget_mb, batch_size=32, headroom=0.1):
+    """
+        The largest micro-batch dividing batch_size (the examples a process takes per optimizer step)
+        whose training, by the memory_profile profile, fits in memory_budget_mb MiB less a headroom share
+        for the allocator, and the gradient accumulation steps that keep batch_size examples per optimizer step.
+        Raises ValueError when even a single example doesn't fit.
+    """
+    logger = logging.getLogger(__name__)
+    usable_mb = memory_budget_mb * (1 - headroom)
+    fitting = [size for size in range(1, batch_size + 1)
+               if batch_size % size == 0 and training_memory_mb(profile, size) <= usable_mb]
+    if not fitting:
+        raise ValueError(f"A single example of {profile['block_size']} tokens needs "
+                         f"{training_memory_mb(profile, 1):.0f} MiB, more than the {usable_mb:.0f} MiB usable "
+                         f"of the {memory_budget_mb} MiB budget"
+                         + ("" if profile["gradient_checkpointing"] else ", try gradient checkpointing"))
+    micro_batch = fitting[-1]
+    logger.info(f'memory budget {memory_budget_mb} MiB, blocks of {profile["block_size"]} tokens, gradient '
+                f'checkpointing {profile["gradient_checkpointing"]}: {profile["static_mb"]:.0f} MiB static + '
+                f'{profile["per_example_mb"]:.1f} MiB per example, micro-batches of {micro_batch} '
+                f'({training_memory_mb(profile, micro_batch):.0f} MiB) accumulated {batch_size // micro_batch} times')
+    return micro_batch, batch_size // micro_batch
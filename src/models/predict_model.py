@@ -3,6 +3,7 @@ import re
 import torch
 from pathlib import Path
 from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+from lora import from_adapter, ADAPTER_CONFIG
 
 PROJECT_DIR = Path(__file__).resolve().parents[2]
 
@@ -187,9 +188,14 @@ genres_artists = {'rap': {'21 Savage',
 
 # Load the model and tokenizer
 model_path = Path(os.path.join(PROJECT_DIR, "models", "gpt2", "model"))
+adapter_path = Path(os.path.join(PROJECT_DIR, "models", "gpt2", "adapter"))
 tokenizer_path = Path(os.path.join(PROJECT_DIR, "models", "gpt2", "tokenizer"))
 
-model = GPT2LMHeadModel.from_pretrained(model_path)
+# A LoRA adapter is loaded on top of the base model it was trained from, merged for generation
+if os.path.exists(os.path.join(adapter_path, ADAPTER_CONFIG)):
+    model = from_adapter(adapter_path)
+else:
+    model = GPT2LMHeadModel.from_pretrained(model_path)
 tokenizer = GPT2TokenizerFast.from_pretrained(tokenizer_path)
 
 # Define the device
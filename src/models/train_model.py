@@ -1,18 +1,33 @@
 from datasets import Dataset
-from transformers import GPT2TokenizerFast
 import torch
 import os
 import re
+import sys
+import json
+import logging
+import time
 import numpy as np
+from pathlib import Path
 from transformers import GPT2LMHeadModel, Trainer, TrainingArguments
-from transformers import AdamW, get_scheduler, EarlyStoppingCallback
+from transformers import get_scheduler, EarlyStoppingCallback
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+sys.path.append(os.path.join(PROJECT_DIR, "src", "data"))
+from tokens import (TokenShards, TokenShardWriter, load_tokenizer, shards_exist, tokenization_key, tokenize_texts,
+                    TOKENS_DIR, TOKEN_CACHE_DIR)
+from instrumentation import peak_rss_mb, PROFILE_DIR
+from lora import add_lora, has_adapter, save_adapter, load_adapter
+from memory_budget import memory_profile, fit_micro_batch, pin_mmap_threshold
 
 os.environ['WANDB_DISABLED'] = 'true'
+# TrainingArguments no longer takes logging_dir, TensorBoard reads it from here
+os.environ.setdefault('TENSORBOARD_LOGGING_DIR', './logs')
 
-if os.path.exists('/kaggle/input/parameters/cleaned_lyrics_data.txt'):
-    file_path = '/kaggle/input/parameters/cleaned_lyrics_data.txt'
-else:
-    file_path = '/kaggle/working/cleaned_lyrics_data2.txt'
+PADDINGS = ("dynamic", "max_length")
+# seed of the split of the songs into training and validation, which evaluate_model.py holds out again
+SPLIT_SEED = 42
+# tokens of context the model is trained on by default, which distill_model.py trains the student on too
+BLOCK_SIZE = 128
 
 from transformers import TrainerCallback
 
@@ -41,130 +56,717 @@ class MetricsLoggerCallback(TrainerCallback):
     def get_metrics(self):
         return self.epochs, self.train_losses, self.eval_losses
 
-class LyricsDataset(torch.utils.data.Dataset):
-    def __init__(self, tokenizer, file_path, block_size):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # Split the content into lyric blocks
-        self.lyric_blocks = re.findall(r'\[s:genre\].*?\[e:genre\]\[s:lyrics\](.*?)\[e:lyrics\]', content, re.DOTALL)
-        if not self.lyric_blocks:
-            raise ValueError("No lyric blocks found. Check the format of the input file.")
-
-        self.examples = []
-        for block in self.lyric_blocks:
-            bpe_tokens = tokenizer(block.strip(), truncation=True, max_length=block_size, padding="max_length", return_tensors="pt")
-            self.examples.append({
-                'input_ids': bpe_tokens['input_ids'][0],
-                'attention_mask': bpe_tokens['attention_mask'][0],
-                'labels': bpe_tokens['input_ids'][0]  
-            })
+class ThroughputCallback(TrainerCallback):
+    """
+        Records, for every logging window of training steps, the tokens per second (padding excluded),
+        seconds per step, time spent waiting on the data loader, shares of the step time spent in forward,
+        backward (with the loss and gradient clipping) and optimizer, and the peak memory of the process.
+        Each record is appended as a JSON line to output_filepath when the Trainer logs.
+        In a distributed run the tokens are summed over the processes, their times averaged and
+        their peak memory maxed, and only the first process writes.
+
+        Forward is timed by hooks on the model and counts the tokens of its attention mask,
+        or the tokens the loss is computed on when the mask isn't one per token (packing).
+        On GPU the timings synchronize the device, so they cover the kernels rather than their launch.
+    """
+
+    def __init__(self, output_filepath=os.path.join(PROFILE_DIR, "training_telemetry.jsonl")):
+        self.output_filepath = Path(output_filepath)
+        self.records = []
+        self._hooks = []
+        self._window = self._new_window()
+        self._idle_since = None
+        self._sync = torch.cuda.synchronize if torch.cuda.is_available() else (lambda: None)
+
+    @staticmethod
+    def _new_window():
+        return {"steps": 0, "tokens": 0, "step_seconds": 0.0, "data_wait_seconds": 0.0,
+                "forward_seconds": 0.0, "backward_seconds": 0.0, "optimizer_seconds": 0.0}
+
+    def _forward_begin(self, module, args, kwargs):
+        if not module.training:
+            return
+        attention_mask, labels = kwargs.get('attention_mask'), kwargs.get('labels')
+        if attention_mask is not None and attention_mask.dim() == 2:
+            self._window["tokens"] += int(attention_mask.sum())
+        elif labels is not None:
+            self._window["tokens"] += int((labels != -100).sum())
+        else:
+            self._window["tokens"] += kwargs['input_ids'].numel()
+        self._sync()
+        self._forward_start = time.perf_counter()
+
+    def _forward_end(self, module, args, output):
+        if not module.training:
+            return
+        self._sync()
+        self._step_forward += time.perf_counter() - self._forward_start
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if state.is_world_process_zero:
+            os.makedirs(self.output_filepath.parent, exist_ok=True)
+            open(self.output_filepath, "w").close()
+        # kept out of torch.compile graphs, they time them from outside
+        self._hooks = [model.register_forward_pre_hook(torch.compiler.disable(self._forward_begin), with_kwargs=True),
+                       model.register_forward_hook(torch.compiler.disable(self._forward_end))]
+        self._idle_since = time.perf_counter()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        # since the last step (or log, evaluation or save) the trainer only fetched the next batches
+        self._window["data_wait_seconds"] += now - self._idle_since
+        self._step_start = now
+        self._step_forward = 0.0
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._sync()
+        self._optimizer_start = time.perf_counter()
+        self._window["forward_seconds"] += self._step_forward
+        self._window["backward_seconds"] += self._optimizer_start - self._step_start - self._step_forward
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self._sync()
+        self._window["optimizer_seconds"] += time.perf_counter() - self._optimizer_start
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self._idle_since = time.perf_counter()
+        self._window["steps"] += 1
+        self._window["step_seconds"] += self._idle_since - self._step_start
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._idle_since = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        self._idle_since = time.perf_counter()
+
+    @staticmethod
+    def _reduce(window, peak_rss):
+        # every process logs at the same steps, so they all get here together
+        if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+            return window, peak_rss
+        world = torch.distributed.get_world_size()
+        keys = list(window)
+        totals = torch.tensor([float(window[key]) for key in keys], dtype=torch.float64)
+        torch.distributed.all_reduce(totals)
+        peak = torch.tensor([peak_rss or 0.0], dtype=torch.float64)
+        torch.distributed.all_reduce(peak, op=torch.distributed.ReduceOp.MAX)
+        window = {key: total if key == "tokens" else total / world for key, total in zip(keys, totals.tolist())}
+        return window, peak.item()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        window = self._window
+        if window["steps"]:
+            window, peak_rss = self._reduce(window, peak_rss_mb())
+            seconds = window["step_seconds"] + window["data_wait_seconds"]
+            record = {
+                "step": state.global_step,
+                "epoch": state.epoch,
+                "loss": (logs or {}).get('loss'),
+                "eval_loss": (logs or {}).get('eval_loss'),
+                "steps": int(window["steps"]),
+                "tokens": int(window["tokens"]),
+                "tokens_per_sec": window["tokens"] / seconds,
+                "seconds_per_step": seconds / window["steps"],
+                "data_wait_seconds": window["data_wait_seconds"],
+                "data_wait_share": window["data_wait_seconds"] / seconds,
+                "forward_share": window["forward_seconds"] / seconds,
+                "backward_share": window["backward_seconds"] / seconds,
+                "optimizer_share": window["optimizer_seconds"] / seconds,
+                "peak_rss_mb": peak_rss,
+                "processes": args.world_size,
+            }
+            if torch.cuda.is_available():
+                record["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2**20
+            self.records.append(record)
+            if state.is_world_process_zero:
+                with open(self.output_filepath, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            self._window = self._new_window()
+        self._idle_since = time.perf_counter()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def get_metrics(self):
+        return self.records
+
+class MemmapLyricsDataset(torch.utils.data.Dataset):
+    """
+        Lyrics dataset over the memory mapped token shards exported by the feature stage (see src/data/tokens.py).
+        It only holds the shards and an array of the documents it serves, and builds the
+        tensors of an example when it is requested, truncated to block_size and,
+        with pad_to_block, padded to it like LyricsDataset.
+    """
+
+    def __init__(self, shards, block_size, pad_token_id, indices=None, pad_to_block=True):
+        self.shards = shards
+        self.block_size = block_size
+        self.pad_token_id = pad_token_id
+        self.indices = np.arange(len(shards)) if indices is None else np.asarray(indices)
+        self.pad_to_block = pad_to_block
 
     def __len__(self):
-        return len(self.examples)
+        return len(self.indices)
+
+    @property
+    def lengths(self):
+        return np.minimum(self.shards.lengths[self.indices], self.block_size)
 
     def __getitem__(self, i):
-        return self.examples[i]
-    
-# Load tokenizer
-tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
-special_tokens_dict = {'additional_special_tokens': ['[s:genre]', '[e:genre]', '[s:lyrics]', '[e:lyrics]']}
-tokenizer.add_special_tokens(special_tokens_dict)
-tokenizer.pad_token = tokenizer.eos_token
-
-# Create dataset
-block_size = 128 # Adjust based on your GPU memory
-dataset = LyricsDataset(tokenizer, file_path, block_size)
-
-from sklearn.model_selection import train_test_split
-
-train_dataset, eval_dataset = train_test_split(dataset, test_size=0.1)  # 10% for validation
-
-model = GPT2LMHeadModel.from_pretrained('gpt2')
-model.resize_token_embeddings(len(tokenizer))
-
-
-training_args = TrainingArguments(
-    output_dir='./results',
-    evaluation_strategy="epoch", 
-    save_strategy="epoch", 
-    logging_strategy="epoch",              
-    num_train_epochs=40,
-    per_device_train_batch_size=32,
-    per_device_eval_batch_size=32,
-    warmup_steps=500,
-    weight_decay=0.01,
-    logging_dir='./logs',
-    save_total_limit=1,
-    load_best_model_at_end=True,
-    metric_for_best_model='loss',
-    greater_is_better=False
-)
-
-optimizer = AdamW(model.parameters(), lr=5e-5)
-
-# Initialize the learning rate scheduler
-num_training_steps = len(train_dataset) * training_args.num_train_epochs
-lr_scheduler = get_scheduler(
-    "cosine",
-    optimizer=optimizer,
-    num_warmup_steps=500,
-    num_training_steps=num_training_steps,
-)
-
-metrics_logger = MetricsLoggerCallback()
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    train_dataset=train_dataset,
-    eval_dataset=eval_dataset,
-    optimizers=(optimizer, lr_scheduler),
-    callbacks=[metrics_logger, EarlyStoppingCallback(early_stopping_patience=3)]
-)
-
-# Train the model
-trainer.train()
-
-# Save the model and configuration
-model.save_pretrained('/kaggle/working/results/best/')
-
-tokenizer.save_pretrained('./results/tokenizer/')
+        ids = torch.from_numpy(self.shards[self.indices[i]][:self.block_size].astype(np.int64))
+        if not self.pad_to_block:
+            return {'input_ids': ids, 'attention_mask': torch.ones_like(ids), 'labels': ids}
+        input_ids = torch.full((self.block_size,), self.pad_token_id, dtype=torch.long)
+        input_ids[:len(ids)] = ids
+        attention_mask = torch.zeros(self.block_size, dtype=torch.long)
+        attention_mask[:len(ids)] = 1
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': input_ids
+        }
 
-import json
 
-# Save TrainingArguments to a JSON file
-args_dict = training_args.to_dict()  # Convert TrainingArguments to a dictionary
-with open('/kaggle/working/results/training_args.json', 'w') as f:
-    json.dump(args_dict, f, indent=4)
-
-    
-import matplotlib.pyplot as plt
-
-# Retrieve logged metrics
-epochs, train_losses, eval_losses = metrics_logger.get_metrics()
-
-# Create the plot
-if epochs:
-    plt.figure(figsize=(12, 6))
-    plt.plot(epochs, train_losses, label='Training Loss', marker='o', color='blue')
-    plt.plot(epochs, eval_losses, label='Validation Loss', marker='x', color='orange')
-    plt.xlabel('Epochs')
-    plt.ylabel('Loss')
-    plt.title('Training and Validation Loss Over All Epochs')
-    plt.legend()
-    plt.grid(True)
-    plt.show()
-    if len(epochs) > 20:  # Check if there are at least 20 epochs
-        zoom_range_start = -20  # Last 20 epochs
+class LyricsDataset(MemmapLyricsDataset):
+    """
+        Lyrics dataset of the lyric blocks of a text file, tokenized once (in batches, spread over n_workers
+        processes) and cached as token shards in cache_dirpath under a key of the file contents,
+        the tokenizer and block_size, so later runs memory map them instead of tokenizing again.
+    """
+
+    def __init__(self, tokenizer, file_path, block_size, pad_to_block=True, cache_dirpath=TOKEN_CACHE_DIR,
+                 n_workers=None):
+        shards_dirpath = Path(cache_dirpath) / tokenization_key(file_path, tokenizer, block_size)
+        if not shards_exist(shards_dirpath):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+
+            # Split the content into lyric blocks
+            lyric_blocks = re.findall(r'\[s:genre\].*?\[e:genre\]\[s:lyrics\](.*?)\[e:lyrics\]', content, re.DOTALL)
+            if not lyric_blocks:
+                raise ValueError("No lyric blocks found. Check the format of the input file.")
+
+            texts = [block.strip() for block in lyric_blocks]
+            n_workers = n_workers or min(os.cpu_count() or 1, 1 + len(texts) // 10**4)
+            with TokenShardWriter(shards_dirpath, tokenizer_ckpt=tokenizer.name_or_path, tokenizer=tokenizer) as writer:
+                writer.add_ids(tokenize_texts(tokenizer, texts, max_length=block_size, n_workers=n_workers))
+
+        super().__init__(TokenShards(shards_dirpath, tokenizer_ckpt=None), block_size, tokenizer.pad_token_id,
+                         pad_to_block=pad_to_block)
+
+
+class DynamicPaddingCollator:
+    """
+        Pads each batch of unpadded examples only to its longest sequence (rounded up to pad_to_multiple_of),
+        instead of every example to block_size. Padding is masked out of the attention and of the loss.
+    """
+
+    def __init__(self, pad_token_id, pad_to_multiple_of=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, examples):
+        length = max(len(example['input_ids']) for example in examples)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch = {
+            'input_ids': torch.full((len(examples), length), self.pad_token_id, dtype=torch.long),
+            'attention_mask': torch.zeros((len(examples), length), dtype=torch.long),
+            'labels': torch.full((len(examples), length), -100, dtype=torch.long),
+        }
+        for row, example in enumerate(examples):
+            n = len(example['input_ids'])
+            batch['input_ids'][row, :n] = example['input_ids']
+            batch['attention_mask'][row, :n] = example['attention_mask']
+            batch['labels'][row, :n] = example['labels']
+        return batch
+
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """
+        Shuffles the examples, sorts every window of bucket_batches batches by length and yields
+        their batches in random order, so each batch holds examples of similar lengths
+        (and little padding once dynamically padded) while every epoch is still shuffled differently.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_batches=50, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        self.epoch += 1
+        order = rng.permutation(len(self.lengths))
+        window = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(order), window):
+            bucket = order[start:start + window]
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        # the data loader cuts the indices back into batches, so the only short batch must stay last
+        last = [batches.pop()] if batches and len(batches[-1]) < self.batch_size else []
+        for b in rng.permutation(len(batches)):
+            yield from batches[b].tolist()
+        for batch in last:
+            yield from batch.tolist()
+
+
+class PackedLyricsDataset(torch.utils.data.Dataset):
+    """
+        Packs the documents of the token shards (prompts ending with their [e:lyrics] marker) back to back,
+        in the order of indices, into windows of block_size tokens, so only the last window has padding.
+        Long documents carry on into the next window. Each example also holds the segment (document)
+        of every position, from which PackingCollator keeps songs from attending to each other.
+    """
+
+    def __init__(self, shards, block_size, indices=None):
+        self.shards = shards
+        self.block_size = block_size
+        self.indices = np.arange(len(shards)) if indices is None else np.asarray(indices)
+        # offset of every document in the packed stream of tokens
+        self.starts = np.concatenate([[0], np.cumsum(shards.lengths[self.indices])])
+
+    def __len__(self):
+        return -(-int(self.starts[-1]) // self.block_size)
+
+    def __getitem__(self, i):
+        begin = i * self.block_size
+        end = min(begin + self.block_size, int(self.starts[-1]))
+        doc = np.searchsorted(self.starts, begin, side="right") - 1
+        pieces, segment_ids = [], []
+        while begin < end:
+            doc_end = min(end, int(self.starts[doc + 1]))
+            offset = begin - int(self.starts[doc])
+            pieces.append(self.shards[self.indices[doc]][offset:offset + doc_end - begin])
+            segment_ids.append(np.full(doc_end - begin, len(segment_ids)))
+            begin = doc_end
+            doc += 1
+
+        input_ids = torch.from_numpy(np.concatenate(pieces).astype(np.int64))
+        segment_ids = torch.from_numpy(np.concatenate(segment_ids))
+        starts = torch.ones_like(segment_ids, dtype=torch.bool)
+        starts[1:] = segment_ids[1:] != segment_ids[:-1]
+        position_ids = torch.arange(len(segment_ids)) - torch.cummax(
+            torch.where(starts, torch.arange(len(segment_ids)), 0), dim=0).values
+        # the first token of a song can't be predicted from the end of the previous one
+        labels = input_ids.masked_fill(starts, -100)
+        return {
+            'input_ids': input_ids,
+            'labels': labels,
+            'position_ids': position_ids,
+            'segment_ids': segment_ids,
+        }
+
+
+class PackingCollator:
+    """
+        Batches packed windows (padding the last one), with position ids restarting at every song and
+        a causal attention mask restricted to each song, given to the model as an additive 4D mask.
+    """
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, examples):
+        length = max(len(example['input_ids']) for example in examples)
+        input_ids = torch.full((len(examples), length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(examples), length), -100, dtype=torch.long)
+        position_ids = torch.zeros((len(examples), length), dtype=torch.long)
+        # padding gets a segment of its own
+        segment_ids = torch.full((len(examples), length), -1, dtype=torch.long)
+        for row, example in enumerate(examples):
+            n = len(example['input_ids'])
+            input_ids[row, :n] = example['input_ids']
+            labels[row, :n] = example['labels']
+            position_ids[row, :n] = example['position_ids']
+            segment_ids[row, :n] = example['segment_ids']
+
+        causal = torch.ones((length, length), dtype=torch.bool).tril()
+        allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+        attention_mask = torch.zeros(allowed.shape, dtype=torch.float32).masked_fill(
+            ~allowed, torch.finfo(torch.float32).min)
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask[:, None],
+            'position_ids': position_ids,
+            'labels': labels,
+        }
+
+
+def example_lengths(dataset):
+    """
+        Number of tokens (padding excluded) of every example of dataset.
+    """
+    if hasattr(dataset, "lengths"):
+        return dataset.lengths
+    return np.array([int(example['attention_mask'].sum()) for example in dataset])
+
+
+class LyricsTrainer(Trainer):
+    """
+        Trainer drawing its training examples from train_sampler (e.g. a LengthBucketSampler) when given.
+        The checkpoints of a model with a LoRA adapter (see lora.py) only hold the adapter.
+    """
+
+    def __init__(self, *args, train_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_sampler = train_sampler
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_sampler is not None:
+            return self.train_sampler
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def _save(self, output_dir=None, state_dict=None):
+        if not has_adapter(self.model):
+            return super()._save(output_dir, state_dict)
+        output_dir = output_dir if output_dir is not None else self.args.output_dir
+        if self.args.should_save:
+            save_adapter(self.model, output_dir)
+            torch.save(self.args, os.path.join(output_dir, "training_args.bin"))
+
+    def _load_best_model(self):
+        if not has_adapter(self.model):
+            return super()._load_best_model()
+        load_adapter(self.model, self.state.best_model_checkpoint)
+
+
+def split_indices(n, test_size=0.1, seed=SPLIT_SEED):
+    """
+        Shuffled train and validation index arrays of a dataset of n examples,
+        with test_size of them (rounded up) for validation, like train_test_split.
+    """
+    order = np.random.default_rng(seed).permutation(n)
+    n_test = int(np.ceil(test_size * n))
+    return order[n_test:], order[:n_test]
+
+
+def host_cpus():
+    """
+        Number of CPUs this process may run on: its affinity, capped by the cgroup CPU quota (containers).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS and Windows
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def cpu_bf16_supported():
+    """
+        Whether the CPU computes in bf16 natively (AVX512-BF16 or AMX on x86, BF16 on Arm),
+        without which bf16 autocast is emulated and slower than float32.
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = {flag for line in f if line.startswith(("flags", "Features"))
+                     for flag in line.split(":", 1)[1].split()}
+    except OSError:
+        return False
+    return bool(flags & {"avx512_bf16", "amx_bf16", "bf16"})
+
+
+def world_size():
+    """
+        Number of training processes, as set by torchrun (1 when not launched by it).
+    """
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
+def cpu_training_args(bf16=None, compile=False, threads=None, interop_threads=1, dataloader_workers=None,
+                      batch_size=8, global_batch_size=32):
+    """
+        TrainingArguments settings to train on a CPU-only host, and sets torch's thread counts for it.
+        bf16 autocast is on when the CPU supports it natively (bf16=None) and compile wraps the model
+        with torch.compile. The data loader gets a worker per 8 CPUs (at most 2, the examples are memory mapped)
+        and the intra-op threads every other CPU. Batches are smaller than on GPU, accumulated
+        to the same global_batch_size examples per optimizer step by default.
+        When torchrun launches several processes per host (distributed data parallel over gloo),
+        they share its CPUs and the global batch.
+    """
+    logger = logging.getLogger(__name__)
+    cpus = max(1, host_cpus() // int(os.environ.get("LOCAL_WORLD_SIZE", 1)))
+    if bf16 is None:
+        bf16 = cpu_bf16_supported()
+    if dataloader_workers is None:
+        dataloader_workers = min(2, cpus // 8)
+    threads = threads or max(1, cpus - dataloader_workers)
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # only possible before torch ran any parallel work
+        logger.warning(f'could not set {interop_threads} inter-op threads, keeping {torch.get_num_interop_threads()}')
+    logger.info(f'CPU training on {cpus} CPUs per process: {threads} intra-op threads, '
+                f'{torch.get_num_interop_threads()} inter-op threads, {dataloader_workers} data loader workers, '
+                f'bf16 {bf16}, compile {compile}')
+
+    return {
+        "ddp_backend": "gloo" if world_size() > 1 else None,
+        # each process divides its loss by its own tokens: evaluating, the tokens of the batches padding the
+        # last round (dropped from the gathered losses) would otherwise still count in every process' loss
+        "average_tokens_across_devices": False,
+        "use_cpu": True,
+        "bf16": bf16,
+        "torch_compile": compile,
+        "dataloader_num_workers": dataloader_workers,
+        "dataloader_persistent_workers": dataloader_workers > 0,
+        "dataloader_pin_memory": False,
+        "per_device_train_batch_size": batch_size,
+        "per_device_eval_batch_size": batch_size,
+        "gradient_accumulation_steps": max(1, global_batch_size // (batch_size * world_size())),
+    }
+
+
+def load_datasets(tokenizer, block_size, test_size=0.1, tokens_dirpath=TOKENS_DIR, file_path=None, pad_to_block=True,
+                  packing=False, seed=SPLIT_SEED):
+    """
+        Training and validation datasets: memory mapped from the token shards in tokens_dirpath when
+        they were exported, else tokenized from the lyrics text file at file_path.
+        Without pad_to_block the examples are left unpadded, for DynamicPaddingCollator.
+        With packing the songs are packed into block_size windows (PackedLyricsDataset),
+        which needs the token shards.
+        seed makes the split the same in every process of a distributed run.
+    """
+    if shards_exist(tokens_dirpath):
+        shards = TokenShards(tokens_dirpath)
+        train_indices, eval_indices = split_indices(len(shards), test_size, seed)
+        if packing:
+            return (PackedLyricsDataset(shards, block_size, train_indices),
+                    PackedLyricsDataset(shards, block_size, eval_indices))
+        return (MemmapLyricsDataset(shards, block_size, tokenizer.pad_token_id, train_indices, pad_to_block),
+                MemmapLyricsDataset(shards, block_size, tokenizer.pad_token_id, eval_indices, pad_to_block))
+    if packing:
+        raise ValueError(f"Packing needs the token shards, please export them to {tokens_dirpath} first.")
+
+    dataset = LyricsDataset(tokenizer, file_path, block_size, pad_to_block)
+    train_indices, eval_indices = split_indices(len(dataset), test_size, seed)
+    return (MemmapLyricsDataset(dataset.shards, block_size, tokenizer.pad_token_id, train_indices, pad_to_block),
+            MemmapLyricsDataset(dataset.shards, block_size, tokenizer.pad_token_id, eval_indices, pad_to_block))
+
+
+def lyrics_file_path():
+    """
+        The lyrics text file to train on when the token shards weren't exported.
+    """
+    if os.path.exists('/kaggle/input/parameters/cleaned_lyrics_data.txt'):
+        return '/kaggle/input/parameters/cleaned_lyrics_data.txt'
+    return '/kaggle/working/cleaned_lyrics_data2.txt'
+
+
+def main(padding="dynamic", length_buckets=True, packing=False, cpu=None, compile=False, lora=False, lora_rank=8,
+         block_size=BLOCK_SIZE, memory_budget_mb=None, gradient_checkpointing=False):
+    """
+        Fine-tunes GPT-2 on the lyrics.
+        padding="dynamic" pads each batch to its longest example (DynamicPaddingCollator) and "max_length"
+        pads every example to block_size. length_buckets batches examples of similar lengths together.
+        packing packs the songs into full block_size windows instead, masking attention between songs
+        (padding and length_buckets don't apply then).
+        cpu trains with the CPU profile of cpu_training_args (by default when there is no GPU),
+        compile wraps the model with torch.compile.
+        lora freezes GPT-2 and only trains low-rank adapters of rank lora_rank (and the embeddings
+        of the added tags), saving the adapter alone (see lora.py).
+        block_size is the context length, at most GPT-2's 1024 tokens. memory_budget_mb splits the examples
+        each process takes per optimizer step into the largest micro-batches whose training fits in that many MiB
+        (of the GPU, or of RAM on CPU), accumulating their gradients (see memory_budget.py).
+        gradient_checkpointing recomputes the activations of each block in the backward instead of keeping them,
+        trading about a third more compute for micro-batches several times larger at long block sizes.
+    """
+    if padding not in PADDINGS:
+        raise ValueError(f"Unknown padding {padding}, expected one of {PADDINGS}")
+
+    file_path = lyrics_file_path()
+
+    if cpu is None:
+        cpu = not torch.cuda.is_available()
+    if cpu:
+        device_args = cpu_training_args(compile=compile)
+    else:
+        device_args = {"per_device_train_batch_size": 32, "per_device_eval_batch_size": 32, "torch_compile": compile}
+    if cpu and memory_budget_mb is not None:
+        # else the heap grows with fragmentation over the steps, past the budget
+        pin_mmap_threshold()
+
+    training_args = TrainingArguments(
+        output_dir='./results',
+        eval_strategy="epoch", 
+        save_strategy="epoch", 
+        logging_strategy="epoch",              
+        num_train_epochs=40,
+        warmup_steps=500,
+        weight_decay=0.01,
+        save_total_limit=1,
+        load_best_model_at_end=True,
+        metric_for_best_model='loss',
+        greater_is_better=False,
+        # the segment ids of packed examples are for PackingCollator, not the model
+        remove_unused_columns=not packing,
+        gradient_checkpointing=gradient_checkpointing,
+        **device_args
+    )
+
+    # Launched by torchrun, the first process of each host downloads and tokenizes while the others wait to reuse its cache
+    with training_args.main_process_first(desc="loading the model and data"):
+        # Load tokenizer
+        tokenizer = load_tokenizer()
+
+        model = GPT2LMHeadModel.from_pretrained('gpt2')
+        if block_size > model.config.n_positions:
+            raise ValueError(f"GPT-2 takes at most {model.config.n_positions} tokens, not blocks of {block_size}")
+
+        # Create dataset
+        train_dataset, eval_dataset = load_datasets(tokenizer, block_size, test_size=0.1, file_path=file_path,
+                                                    pad_to_block=padding == "max_length",
+                                                    packing=packing)  # 10% for validation
+
+        base_vocab_size = model.config.vocab_size
+        model.resize_token_embeddings(len(tokenizer))
+        if lora:
+            add_lora(model, r=lora_rank, trainable_from=base_vocab_size)
+
+    if memory_budget_mb is not None:
+        # the examples per optimizer step stay, split into the micro-batches that fit
+        batch_size = training_args.per_device_train_batch_size * training_args.gradient_accumulation_steps
+        profile = memory_profile(model.to(training_args.device), block_size, gradient_checkpointing,
+                                 bf16=training_args.bf16, memory_budget_mb=memory_budget_mb)
+        micro_batch, _ = fit_micro_batch(profile, memory_budget_mb, batch_size)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            # every process has to accumulate as many micro-batches
+            fitted = torch.tensor(micro_batch, device=training_args.device)
+            torch.distributed.all_reduce(fitted, op=torch.distributed.ReduceOp.MIN)
+            micro_batch = int(fitted)
+        training_args.per_device_train_batch_size = micro_batch
+        training_args.per_device_eval_batch_size = micro_batch
+        training_args.gradient_accumulation_steps = batch_size // micro_batch
+
+    if packing:
+        data_collator = PackingCollator(tokenizer.pad_token_id)
+    elif padding == "dynamic":
+        # a few padded lengths instead of one per batch, each of which torch.compile would compile for
+        data_collator = DynamicPaddingCollator(tokenizer.pad_token_id, pad_to_multiple_of=32 if compile else None)
+    else:
+        data_collator = None
+
+    # the optimizer only keeps state for the weights that train, adapters take a larger learning rate
+    optimizer = torch.optim.AdamW([param for param in model.parameters() if param.requires_grad],
+                                  lr=2e-4 if lora else 5e-5, weight_decay=0.0)
+
+    # Initialize the learning rate scheduler
+    num_training_steps = len(train_dataset) * training_args.num_train_epochs
+    lr_scheduler = get_scheduler(
+        "cosine",
+        optimizer=optimizer,
+        num_warmup_steps=500,
+        num_training_steps=num_training_steps,
+    )
+
+    metrics_logger = MetricsLoggerCallback()
+    throughput_logger = ThroughputCallback()
+    trainer = LyricsTrainer(
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        data_collator=data_collator,
+        optimizers=(optimizer, lr_scheduler),
+        callbacks=[metrics_logger, throughput_logger, EarlyStoppingCallback(early_stopping_patience=3)],
+        train_sampler=LengthBucketSampler(example_lengths(train_dataset),
+                                          training_args.per_device_train_batch_size)
+                      if length_buckets and not packing else None
+    )
+
+    # Train the model
+    trainer.train()
+
+    # Every process holds the same trained model, the first one saves it
+    if not trainer.is_world_process_zero():
+        return
+
+    # Save the model and configuration
+    if lora:
+        save_adapter(model, '/kaggle/working/results/best/adapter/')
+    else:
+        model.save_pretrained('/kaggle/working/results/best/')
+
+    tokenizer.save_pretrained('./results/tokenizer/')
+
+    # Save TrainingArguments to a JSON file
+    args_dict = training_args.to_dict()  # Convert TrainingArguments to a dictionary
+    with open('/kaggle/working/results/training_args.json', 'w') as f:
+        json.dump(args_dict, f, indent=4)
+
+
+    import matplotlib.pyplot as plt
+
+    # Retrieve logged metrics
+    epochs, train_losses, eval_losses = metrics_logger.get_metrics()
+
+    # Create the plot
+    if epochs:
         plt.figure(figsize=(12, 6))
-        plt.plot(epochs[zoom_range_start:], train_losses[zoom_range_start:], label='Training Loss', marker='o', color='blue')
-        plt.plot(epochs[zoom_range_start:], eval_losses[zoom_range_start:], label='Validation Loss', marker='x', color='orange')
-        plt.xlabel('Epochs (Last 20)')
+        plt.plot(epochs, train_losses, label='Training Loss', marker='o', color='blue')
+        plt.plot(epochs, eval_losses, label='Validation Loss', marker='x', color='orange')
+        plt.xlabel('Epochs')
         plt.ylabel('Loss')
-        plt.title('Training and Validation Loss Over Last 20 Epochs')
+        plt.title('Training and Validation Loss Over All Epochs')
         plt.legend()
         plt.grid(True)
         plt.show()
-    
-else:
-    print("No data to plot. Check the data collection process.")
\ No newline at end of file
+        if len(epochs) > 20:  # Check if there are at least 20 epochs
+            zoom_range_start = -20  # Last 20 epochs
+            plt.figure(figsize=(12, 6))
+            plt.plot(epochs[zoom_range_start:], train_losses[zoom_range_start:], label='Training Loss', marker='o', color='blue')
+            plt.plot(epochs[zoom_range_start:], eval_losses[zoom_range_start:], label='Validation Loss', marker='x', color='orange')
+            plt.xlabel('Epochs (Last 20)')
+            plt.ylabel('Loss')
+            plt.title('Training and Validation Loss Over Last 20 Epochs')
+            plt.legend()
+            plt.grid(True)
+            plt.show()
+
+    else:
+        print("No data to plot. Check the data collection process.")
+
+    # Throughput telemetry, also saved as JSON lines in throughput_logger.output_filepath
+    telemetry = throughput_logger.get_metrics()
+    if telemetry:
+        steps = [record['step'] for record in telemetry]
+        fig, (ax_tokens, ax_shares) = plt.subplots(1, 2, figsize=(16, 6))
+        ax_tokens.plot(steps, [record['tokens_per_sec'] for record in telemetry], marker='o', color='green')
+        ax_tokens.set_xlabel('Steps')
+        ax_tokens.set_ylabel('Tokens/sec (padding excluded)')
+        ax_tokens.set_title('Training Throughput')
+        ax_tokens.grid(True)
+        shares = ['data_wait_share', 'forward_share', 'backward_share', 'optimizer_share']
+        ax_shares.stackplot(steps, *[[record[share] for record in telemetry] for share in shares],
+                            labels=[share.replace('_share', '').replace('_', ' ') for share in shares])
+        ax_shares.set_xlabel('Steps')
+        ax_shares.set_ylabel('Share of the step time')
+        ax_shares.set_title('Where the Training Time Goes')
+        ax_shares.legend(loc='upper right')
+        plt.show()
+
+
+if __name__ == '__main__':
+    main()
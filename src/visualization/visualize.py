@@ -1,8 +1,8 @@
 import os
+import sys
 import logging
 import spacy
 spacy.load('en_core_web_sm')
-import pandas as pd
 from wordcloud import WordCloud
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -11,6 +11,8 @@ import webbrowser
 from pathlib import Path
 
 PROJECT_DIR = Path(__file__).resolve().parents[2]
+sys.path.append(os.path.join(PROJECT_DIR, "src", "data"))
+from storage import dataset_filepath, read_dataset
 
 
 def visualize():
@@ -24,14 +26,16 @@ def visualize():
     
     
     # paths
-    processed_filepath = Path(os.path.join(PROJECT_DIR, "data", "processed", "lyrics_processed.csv"))
+    processed_filepath = dataset_filepath("processed", "lyrics_processed", "parquet")
+    if not os.path.exists(processed_filepath):
+        processed_filepath = dataset_filepath("processed", "lyrics_processed", "csv")
     figures_filepath = Path(os.path.join(PROJECT_DIR, "reports", "figures"))
     eda_report_filepath = Path(os.path.join(PROJECT_DIR, "reports", "eda_report"))
     
     
     # Load the dataset
     logger.info('loading preprocessed dataset')
-    data = pd.read_csv(processed_filepath)
+    data = read_dataset(processed_filepath)
     
     
     
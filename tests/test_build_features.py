@@ -0,0 +1,50 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(os.path.join(PROJECT_DIR, "src", "data"))
+from build_features import lyrics_prompter, lyrics_prompts
+
+
+@pytest.fixture
+def songs():
+    # as the feature build stores them, plus NaN and empty lyrics, a missing artist and a missing year
+    return pd.DataFrame({
+        "cleaned_lyrics": ["love me \"tonight\"", np.nan, "", "café au lait", None, "  spaced  "],
+        "tag": ["rap", "pop", "rb", "country", "rock", "rap"],
+        "artist": ["Drake", "Beyoncé", "AC/DC", np.nan, "Guns N' Roses", "50 Cent"],
+        "year": [2001.0, 1999.0, np.nan, 1985.0, 2010.0, 2022.0],
+    })
+
+
+def expected_prompts(lyrics, genres, artists, years):
+    return [lyrics_prompter(*row) for row in zip(lyrics, genres, artists, years)]
+
+
+def test_lyrics_prompts_per_row_values(songs):
+    prompts = lyrics_prompts(songs["cleaned_lyrics"], songs["tag"], songs["artist"], songs["year"])
+    assert prompts.tolist() == expected_prompts(songs["cleaned_lyrics"], songs["tag"], songs["artist"], songs["year"])
+    assert prompts.index.equals(songs.index)
+
+
+def test_lyrics_prompts_shared_values(songs):
+    prompts = lyrics_prompts(songs["cleaned_lyrics"], "rap", "Drake", songs["year"])
+    n = len(songs)
+    assert prompts.tolist() == expected_prompts(songs["cleaned_lyrics"], ["rap"] * n, ["Drake"] * n, songs["year"])
+
+
+@pytest.mark.parametrize("dtype", [object, "string[pyarrow]"])
+def test_lyrics_prompts_lyrics_dtypes(songs, dtype):
+    lyrics = songs["cleaned_lyrics"].astype(dtype)
+    years = songs["year"].fillna(2000).astype(np.int16)
+    prompts = lyrics_prompts(lyrics, songs["tag"], songs["artist"], years)
+    assert prompts.tolist() == expected_prompts(lyrics, songs["tag"], songs["artist"], years)
+
+
+def test_lyrics_prompts_unknown_genre(songs):
+    with pytest.raises(KeyError):
+        lyrics_prompts(songs["cleaned_lyrics"], songs["tag"].replace("rb", "jazz"), songs["artist"], songs["year"])